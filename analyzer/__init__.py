@@ -1 +1 @@
-__all__ = ['topline']
\ No newline at end of file
+__all__ = ['topline', 'spatial', 'loader', 'cache', 'report_sink']
\ No newline at end of file
@@ -0,0 +1,79 @@
+import hashlib
+import json
+import os
+
+try:
+    from pyarrow import feather
+except ImportError:
+    feather = None
+
+# 准备数据的方式改变时增加版本号, 旧的缓存不再使用
+_CACHE_VERSION = 2
+
+# 缓存的DataFrame, 文件名为 <键>-<名称>.feather
+_FRAME_NAMES = ('restaurants', 'menus', 'unique_restaurants')
+
+
+def _file_identity(path):
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+
+
+def cache_key(db_file, **params):
+    """
+    :param params: 影响准备结果的参数(范围过滤等)
+    :return: 由数据库文件的路径, 大小, 修改时间和参数生成的键
+    """
+    identity = {'version': _CACHE_VERSION, 'db': _file_identity(db_file), 'params': params}
+    # WAL模式下提交的数据在checkpoint之前只在-wal文件中, 主文件的修改时间不变
+    if os.path.exists(db_file + '-wal'):
+        identity['wal'] = _file_identity(db_file + '-wal')
+    return hashlib.sha1(json.dumps(identity, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def cache_dir(db_name):
+    return db_name + '-cache'
+
+
+def _frame_path(directory, key, name):
+    return os.path.join(directory, '{}-{}.feather'.format(key, name))
+
+
+def load_frames(directory, key, names=_FRAME_NAMES, read_only=False):
+    """
+    :param read_only: 数值列直接使用映射的文件内存(只读), 不复制
+    :return: {名称: DataFrame}, 没有pyarrow或没有缓存时为None
+    """
+    if feather is None:
+        return None
+    paths = dict((name, _frame_path(directory, key, name)) for name in names)
+    if not all(os.path.exists(path) for path in paths.values()):
+        return None
+    return dict((name, feather.read_table(path, memory_map=True).to_pandas(split_blocks=read_only))
+                for name, path in paths.items())
+
+
+def write_frames(directory, key, frames):
+    """
+    :param frames: {名称: DataFrame}
+    """
+    for name, df in frames.items():
+        path = _frame_path(directory, key, name)
+        # 不压缩, 读取时可以直接映射文件
+        feather.write_feather(df.reset_index(drop=True), path + '.tmp', compression='uncompressed')
+        os.replace(path + '.tmp', path)
+
+
+def save_frames(directory, key, frames):
+    """
+    写入新的缓存并删除同一目录中其他键的缓存
+    :param frames: {名称: DataFrame}
+    """
+    if feather is None:
+        return
+    os.makedirs(directory, exist_ok=True)
+    write_frames(directory, key, frames)
+
+    for filename in os.listdir(directory):
+        if filename.endswith('.feather') and not filename.startswith(key + '-'):
+            os.remove(os.path.join(directory, filename))
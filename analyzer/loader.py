@@ -0,0 +1,63 @@
+import sqlite3
+from contextlib import closing
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+# 每次从数据库读取的行数
+_DEFAULT_CHUNK_SIZE = 100000
+
+# 报告用到的列: (列名, 类型), 类型为 integer 整数向下转换, float 保持float64, category 字符串转换成分类
+_TABLE_COLUMNS = {
+    'restaurants': [('id', 'integer'), ('name', 'category'), ('rating_count', 'integer'),
+                    ('month_sales', 'integer'), ('latitude', 'float'), ('longitude', 'float')],
+    'menus': [('restaurant_id', 'integer'), ('name', 'category'), ('rating_count', 'integer'),
+              ('price', 'float'), ('month_sales', 'integer')],
+    'category': [('id', 'integer'), ('name', 'category')],
+    'restaurant_categories': [('category_id', 'integer'), ('restaurant_id', 'integer')],
+}
+
+
+def _convert_chunk(chunk, columns):
+    for column, kind in columns:
+        if kind == 'integer':
+            # 有NULL的列保持float64
+            chunk[column] = pd.to_numeric(chunk[column], downcast='integer')
+        elif kind == 'category':
+            chunk[column] = chunk[column].astype('category')
+    return chunk
+
+
+def _concat_chunks(chunks, columns):
+    """
+    分类列合并各个块的分类, 数值列合并后的类型能容纳所有块的数值
+    """
+    data = {}
+    for column, kind in columns:
+        if kind == 'category':
+            data[column] = union_categoricals([chunk[column] for chunk in chunks])
+        else:
+            data[column] = np.concatenate([chunk[column].values for chunk in chunks])
+    return pd.DataFrame(data)
+
+
+def read_table(conn, table, chunk_size=_DEFAULT_CHUNK_SIZE):
+    """
+    分块读取一张表中报告用到的列
+    :param conn: sqlite3连接
+    """
+    columns = _TABLE_COLUMNS[table]
+    sql = 'SELECT {} FROM {}'.format(','.join(column for column, kind in columns), table)
+    chunks = [_convert_chunk(chunk, columns) for chunk in pd.read_sql_query(sql, conn, chunksize=chunk_size)]
+    if len(chunks) == 0:
+        return _convert_chunk(pd.DataFrame(dict((column, []) for column, kind in columns)), columns)
+    return _concat_chunks(chunks, columns)
+
+
+def load_tables(db_file, chunk_size=_DEFAULT_CHUNK_SIZE):
+    """
+    :return: {表名: DataFrame}
+    """
+    with closing(sqlite3.connect(db_file)) as conn:
+        return dict((table, read_table(conn, table, chunk_size)) for table in _TABLE_COLUMNS)
@@ -0,0 +1,117 @@
+import math
+import os
+import re
+
+import pandas as pd
+from pandas import ExcelWriter
+
+try:
+    import xlsxwriter
+except ImportError:
+    xlsxwriter = None
+
+
+def _file_name(sheet_name):
+    """
+    工作表名中不能用在文件名里的字符
+    """
+    return re.sub(r'[\\/:*?"|]', '_', sheet_name.replace('<', 'lt').replace('>', 'gt'))
+
+
+class _ReportSink(object):
+    """
+    报告的输出, 每个工作表生成后立即调用write, 不需要保存整个报告
+    """
+
+    def write(self, sheet_name, df):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class ExcelSink(_ReportSink):
+    """
+    原有的输出方式: pandas.ExcelWriter, 整个工作簿在close时写入文件
+    """
+
+    def __init__(self, base_name):
+        self.path = base_name + '.xlsx'
+        self._writer = ExcelWriter(self.path)
+
+    def write(self, sheet_name, df):
+        df.to_excel(self._writer, sheet_name=sheet_name)
+
+    def close(self):
+        self._writer.close()
+
+
+class StreamingExcelSink(_ReportSink):
+    """
+    xlsxwriter的constant_memory模式: 按行顺序写入, 写完的行直接进入临时文件, 内存中只保留当前行
+    """
+
+    def __init__(self, base_name):
+        if xlsxwriter is None:
+            raise ImportError('StreamingExcelSink需要安装xlsxwriter')
+        self.path = base_name + '.xlsx'
+        self._workbook = xlsxwriter.Workbook(self.path, {'constant_memory': True})
+        self._header_format = self._workbook.add_format({'bold': True, 'border': 1, 'align': 'center'})
+
+    def write(self, sheet_name, df):
+        worksheet = self._workbook.add_worksheet(sheet_name)
+        worksheet.write_row(0, 1, list(df.columns), self._header_format)
+
+        # 按列转换成python对象后逐行写入, 与to_excel一样第一列为索引, 空值不写, 无穷大写成inf
+        columns = [df.index.tolist()] + [df.iloc[:, i].tolist() for i in range(0, df.shape[1])]
+        for row, values in enumerate(zip(*columns), 1):
+            for column, value in enumerate(values):
+                if isinstance(value, float) and math.isinf(value):
+                    worksheet.write_string(row, column, 'inf' if value > 0 else '-inf')
+                elif not pd.isna(value):
+                    worksheet.write(row, column, value)
+
+    def close(self):
+        self._workbook.close()
+
+
+class CsvSink(_ReportSink):
+    """
+    每个工作表一个CSV文件(带BOM, Excel可以直接打开), 放在以报告名命名的目录中
+    """
+
+    def __init__(self, base_name):
+        self.path = base_name
+        os.makedirs(self.path, exist_ok=True)
+
+    def write(self, sheet_name, df):
+        df.to_csv(os.path.join(self.path, _file_name(sheet_name) + '.csv'), encoding='utf-8-sig')
+
+
+class ParquetSink(_ReportSink):
+    """
+    每个工作表一个Parquet文件, 放在以报告名命名的目录中(需要pyarrow)
+    """
+
+    def __init__(self, base_name):
+        self.path = base_name
+        os.makedirs(self.path, exist_ok=True)
+
+    def write(self, sheet_name, df):
+        # Parquet的列名必须是字符串, 补齐的空行会让数值列变成object
+        df = df.infer_objects().rename(columns=str)
+        df.to_parquet(os.path.join(self.path, _file_name(sheet_name) + '.parquet'))
+
+
+SINKS = {
+    'excel': ExcelSink,
+    'excel-stream': StreamingExcelSink,
+    'csv': CsvSink,
+    'parquet': ParquetSink,
+}
@@ -0,0 +1,143 @@
+from math import cos, radians
+
+import numpy as np
+
+_EQUATORIAL_RADIUS = 6378.140  # 赤道半径 (km)
+_POLAR_RADIUS = 6356.755  # 极半径 (km)
+
+# 每度纬度/经度(赤道)的最短距离(km), 用于把半径换算成不小于实际范围的经纬度范围
+_KM_PER_LAT_DEGREE = 110.574
+_KM_PER_LON_DEGREE = 111.320
+
+# 网格边长(度), 约1公里
+_DEFAULT_CELL_SIZE = 0.01
+
+
+def calc_distance_array(lat_a, lng_a, lat_b, lng_b):
+    """
+    Analyzer.calcDistance的向量化版本(Andoyer-Lambert), 参数可以是数组或标量
+    :return: 距离(km), 两点重合时为0
+    """
+    flatten = (_EQUATORIAL_RADIUS - _POLAR_RADIUS) / _EQUATORIAL_RADIUS
+    pA = np.arctan(_POLAR_RADIUS / _EQUATORIAL_RADIUS * np.tan(np.radians(lat_a)))
+    pB = np.arctan(_POLAR_RADIUS / _EQUATORIAL_RADIUS * np.tan(np.radians(lat_b)))
+    cos_xx = np.sin(pA) * np.sin(pB) + np.cos(pA) * np.cos(pB) * np.cos(np.radians(lng_a) - np.radians(lng_b))
+    xx = np.arccos(np.clip(cos_xx, -1.0, 1.0))
+
+    # xx为0(两点重合)时c2的分母为0, 此时距离为0
+    degenerate = xx == 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        c1 = (np.sin(xx) - xx) * (np.sin(pA) + np.sin(pB)) ** 2 / np.cos(xx / 2) ** 2
+        c2 = (np.sin(xx) + xx) * (np.sin(pA) - np.sin(pB)) ** 2 / np.sin(xx / 2) ** 2
+        distance = _EQUATORIAL_RADIUS * (xx + flatten / 8 * (c1 - c2))
+    return np.where(degenerate, 0.0, distance)
+
+
+class GridIndex(object):
+    """
+    经纬度等分网格索引. 点按网格排序, 每个网格对应排序后数组中连续的一段,
+    查询只读取与查询范围重叠的网格中的点
+    """
+
+    def __init__(self, latitudes, longitudes, cell_size=_DEFAULT_CELL_SIZE):
+        """
+        :param cell_size: 网格边长(度). 查询结果为点在输入数组中的位置
+        """
+        self.cell_size = cell_size
+        self.latitudes = np.asarray(latitudes, dtype=np.float64)
+        self.longitudes = np.asarray(longitudes, dtype=np.float64)
+
+        # 没有坐标的点不进入索引
+        valid = np.flatnonzero(np.isfinite(self.latitudes) & np.isfinite(self.longitudes))
+        lat_keys = np.floor(self.latitudes[valid] / cell_size).astype(np.int64)
+        lon_keys = np.floor(self.longitudes[valid] / cell_size).astype(np.int64)
+        order = np.lexsort((lat_keys, lon_keys))
+        self._order = valid[order]
+        lon_keys = lon_keys[order]
+        lat_keys = lat_keys[order]
+
+        boundaries = np.flatnonzero((np.diff(lon_keys) != 0) | (np.diff(lat_keys) != 0)) + 1
+        starts = np.concatenate([[0], boundaries]).astype(np.int64)
+        ends = np.concatenate([boundaries, [len(self._order)]]).astype(np.int64)
+        self._cells = dict(((lon_keys[start], lat_keys[start]), (start, end))
+                           for start, end in zip(starts.tolist(), ends.tolist()) if start != end)
+
+        if len(self._order) != 0:
+            self._key_bounds = (lon_keys.min(), lat_keys.min(), lon_keys.max(), lat_keys.max())
+            max_abs_lat = np.abs(self.latitudes[valid]).max() + cell_size
+        else:
+            self._key_bounds = (0, 0, -1, -1)
+            max_abs_lat = 0.0
+        # 一个网格在任意方向上的最短距离(km)
+        self._min_cell_km = cell_size * min(_KM_PER_LAT_DEGREE,
+                                            _KM_PER_LON_DEGREE * cos(radians(min(max_abs_lat, 89.9))))
+
+    def __len__(self):
+        return len(self._order)
+
+    def _key(self, value):
+        return int(np.floor(value / self.cell_size))
+
+    def _candidates(self, min_lon_key, min_lat_key, max_lon_key, max_lat_key):
+        """
+        :return: 网格范围内所有点的位置
+        """
+        min_lon_key = max(min_lon_key, self._key_bounds[0])
+        min_lat_key = max(min_lat_key, self._key_bounds[1])
+        max_lon_key = min(max_lon_key, self._key_bounds[2])
+        max_lat_key = min(max_lat_key, self._key_bounds[3])
+
+        slices = []
+        for lon_key in range(min_lon_key, max_lon_key + 1):
+            for lat_key in range(min_lat_key, max_lat_key + 1):
+                cell = self._cells.get((lon_key, lat_key))
+                if cell is not None:
+                    slices.append(self._order[cell[0]:cell[1]])
+        return np.concatenate(slices) if len(slices) != 0 else np.empty(0, dtype=np.int64)
+
+    def bbox(self, min_lat, min_lon, max_lat, max_lon):
+        """
+        :return: 在经纬度范围内(包括边界)的点的位置
+        """
+        positions = self._candidates(self._key(min_lon), self._key(min_lat), self._key(max_lon), self._key(max_lat))
+        lats = self.latitudes[positions]
+        lons = self.longitudes[positions]
+        return positions[(lats >= min_lat) & (lats <= max_lat) & (lons >= min_lon) & (lons <= max_lon)]
+
+    def radius(self, lat, lon, radius):
+        """
+        :param radius: 半径(km)
+        :return: (位置, 距离), 距离不大于radius的点
+        """
+        dlat = radius / _KM_PER_LAT_DEGREE
+        dlon = radius / (_KM_PER_LON_DEGREE * cos(radians(min(abs(lat) + dlat, 89.9))))
+        positions = self._candidates(self._key(lon - dlon), self._key(lat - dlat),
+                                     self._key(lon + dlon), self._key(lat + dlat))
+        distance = calc_distance_array(self.latitudes[positions], self.longitudes[positions], lat, lon)
+        within = distance <= radius
+        return positions[within], distance[within]
+
+    def knn(self, lat, lon, k):
+        """
+        从查询点所在网格向外逐圈扩大范围, 第k近的点的距离不超过已覆盖的范围时停止
+        :return: (位置, 距离), 按距离从近到远排序
+        """
+        k = min(k, len(self))
+        if k <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+
+        lon_key, lat_key = self._key(lon), self._key(lat)
+        max_ring = max(abs(lon_key - self._key_bounds[0]), abs(lon_key - self._key_bounds[2]),
+                       abs(lat_key - self._key_bounds[1]), abs(lat_key - self._key_bounds[3]))
+        # 查询点在数据范围之外时, 从最近的有数据的一圈开始
+        ring = max(0, self._key_bounds[0] - lon_key, lon_key - self._key_bounds[2],
+                   self._key_bounds[1] - lat_key, lat_key - self._key_bounds[3])
+        while True:
+            positions = self._candidates(lon_key - ring, lat_key - ring, lon_key + ring, lat_key + ring)
+            if len(positions) >= k:
+                distance = calc_distance_array(self.latitudes[positions], self.longitudes[positions], lat, lon)
+                kth = np.partition(distance, k - 1)[k - 1]
+                if kth <= ring * self._min_cell_km or ring >= max_ring:
+                    nearest = np.argsort(distance, kind='stable')[:k]
+                    return positions[nearest], distance[nearest]
+            ring += 1
@@ -1,8 +1,14 @@
 from math import *
 
+import copy
+import multiprocessing
+import re
+import tempfile
+
+import numpy as np
 import pandas as pd
-import sqlalchemy
-from pandas import ExcelWriter
+
+from analyzer import cache, loader, report_sink, spatial
 
 _ORDER_BY_KEYWORD = ['rating_count', 'month_sales', 'revenue']
 
@@ -14,7 +20,7 @@ _COLUMN_NAME_DICT = {
 
 _DISK_CATEGORY_KEYWORDS = {
     'staple': ['面', '饭', '粥', '馒头', '花卷', '馄饨', '饺', '包', '粉', '饼'],
-    'drinking': ['酒,''咖啡', '雪碧', '可乐', '茶', '拿铁'],
+    'drinking': ['酒', '咖啡', '雪碧', '可乐', '茶', '拿铁'],
     'dessert': ['布丁', '蛋糕', '饼干', '曲奇']
 }
 
@@ -25,9 +31,102 @@ _PRICE_RANGES = [{'low': 1.0, 'high': 30.0},
                  {'low': 81.0, 'high': 120.0},
                  {'low': 121.0, 'high': 99999.0}]
 
+# 报告中的价格范围, None为全部数据, 否则是_PRICE_RANGES中的序号
+_BANDS = [None] + list(range(0, len(_PRICE_RANGES)))
+
 # 用哪个值作为平均价格 [ mean_price, average_price ]
 _AVERAGE_PRICE = 'average_price'
 
+# 报告使用的Analyzer属性, 并行生成时传给每个进程
+_REPORT_SETTINGS = ('order_by', 'ranking_list_size', 'restaurant_list_size', 'menu_list_size', 'scaling')
+
+# 并行生成报告时共享数据文件的键
+_SHARED_FRAMES_KEY = 'shared'
+
+# 报告进程用spawn启动, 数据只通过内存映射的文件共享
+_PROCESS_CONTEXT = multiprocessing.get_context('spawn')
+
+
+class DishClassifier(object):
+    """
+    按菜名中的关键词给菜品分类. 每种类型的关键词编译成一个正则表达式,
+    按关键词表的顺序第一个匹配的类型优先, 都不匹配时为default
+    """
+
+    def __init__(self, keywords=_DISK_CATEGORY_KEYWORDS, default='vegetable'):
+        self.types = list(keywords)
+        self.default = default
+        self._patterns = [re.compile('|'.join(re.escape(keyword) for keyword in keywords[dish_type]))
+                          for dish_type in self.types]
+
+    def classify(self, names):
+        """
+        :param names: 菜名Series, 每个不同的菜名只匹配一次
+        :return: 与names对应的类型(分类)
+        """
+        names = names.astype('category')
+        unique_names = pd.Series(names.cat.categories)
+        conditions = [unique_names.str.contains(pattern).values for pattern in self._patterns]
+        type_codes = np.select(conditions, list(range(0, len(self.types))), default=len(self.types))
+        # 空菜名的编号为-1, 对应最后加上的default
+        type_codes = np.append(type_codes, len(self.types))
+        return pd.Series(pd.Categorical.from_codes(type_codes[names.cat.codes.values], self.types + [self.default]),
+                         index=names.index)
+
+
+def _menu_totals(menus_db):
+    """
+    菜品的聚合结果, 缩放不改变菜品的数值
+    :return: (dish_totals, menu_totals), dish_totals为{band: DataFrame}
+    """
+    dish_totals = {}
+    for band in _BANDS:
+        menus_df = menus_db
+        if band is not None:
+            pr = _PRICE_RANGES[band]
+            menus_df = menus_df[(menus_df['price'] >= pr['low']) & (menus_df['price'] <= pr['high'])]
+        dish_totals[band] = menus_df.loc[:, ['cat_name', 'type', 'name'] + _ORDER_BY_KEYWORD].groupby(
+            ['cat_name', 'type', 'name'], observed=True).sum()
+
+    f = {'rating_count': 'sum', 'month_sales': 'sum', 'price': 'mean', 'revenue': 'sum'}
+    menu_totals = menus_db.loc[:, ['name', 'rating_count', 'month_sales', 'price', 'revenue']].groupby(
+        'name', observed=True).agg(f)[['rating_count', 'month_sales', 'price', 'revenue']]
+    return dish_totals, menu_totals
+
+
+class ReportCube(object):
+    """
+    报告用到的分组聚合结果, 与order_by无关, 每种排序的报告只在其中排序选取前N名.
+    band为None时是全部数据, 否则是_PRICE_RANGES中的序号
+    """
+
+    def __init__(self, restaurants_db, menus_db=None, totals=None):
+        """
+        :param totals: 已经计算好的_menu_totals(menus_db), None时由menus_db计算
+        """
+        self.bands = _BANDS
+        self.restaurants = {}
+        self.category_totals = {}
+        self.update_restaurants(restaurants_db)
+        self.dish_totals, self.menu_totals = totals if totals is not None else _menu_totals(menus_db)
+
+    def update_restaurants(self, restaurants_db):
+        """
+        重新计算商家的聚合结果, 缩放只改变商家的数值, 菜品的聚合结果不变
+        """
+        for band in self.bands:
+            restaurants_df = restaurants_db
+            if band is not None:
+                pr = _PRICE_RANGES[band]
+                restaurants_df = restaurants_df[(restaurants_df[_AVERAGE_PRICE] >= pr['low']) & (
+                    restaurants_df[_AVERAGE_PRICE] <= pr['high'])]
+            self.restaurants[band] = restaurants_df
+
+            grouped = restaurants_df.loc[:, ['cat_name'] + _ORDER_BY_KEYWORD].groupby('cat_name', observed=True)
+            totals = grouped.sum()
+            totals['count'] = grouped.size()
+            self.category_totals[band] = totals
+
 
 class Analyzer(object):
     is_limit_range = False
@@ -47,14 +146,19 @@ class Analyzer(object):
         rad_lng_B = radians(Lng_B)
         pA = atan(rb / ra * tan(rad_lat_A))
         pB = atan(rb / ra * tan(rad_lat_B))
-        xx = acos(sin(pA) * sin(pB) + cos(pA) * cos(pB) * cos(rad_lng_A - rad_lng_B))
+        xx = acos(min(1.0, sin(pA) * sin(pB) + cos(pA) * cos(pB) * cos(rad_lng_A - rad_lng_B)))
+        if xx == 0:
+            return 0.0
         c1 = (sin(xx) - xx) * (sin(pA) + sin(pB)) ** 2 / cos(xx / 2) ** 2
         c2 = (sin(xx) + xx) * (sin(pA) - sin(pB)) ** 2 / sin(xx / 2) ** 2
         dr = flatten / 8 * (c1 - c2)
         distance = ra * (xx + dr)
         return distance
 
-    def __init__(self, db_name, lon=None, lat=None, range=None):
+    def __init__(self, db_name, lon=None, lat=None, range=None, use_cache=True):
+        """
+        :param use_cache: 数据库和过滤参数没有变化时直接读取上一次准备好的数据(需要pyarrow)
+        """
         self.db_name = db_name
         self.db_file = db_name + '-data.db'
         self.order_by = 'rating_count'
@@ -63,22 +167,48 @@ class Analyzer(object):
         self.menu_list_size = 150
         self.scaling = 0.1
 
+        cache_dir = cache.cache_dir(db_name)
+        cache_key = cache.cache_key(self.db_file, lon=lon, lat=lat, range=range)
+        frames = cache.load_frames(cache_dir, cache_key) if use_cache else None
+        if frames is not None:
+            print('加载缓存', cache_dir, '...')
+            self.restaurants_db = frames['restaurants']
+            self.menus_db = frames['menus']
+            self._unique_restaurants = frames['unique_restaurants']
+        else:
+            self._prepare(lon, lat, range)
+            if use_cache:
+                cache.save_frames(cache_dir, cache_key, {'restaurants': self.restaurants_db, 'menus': self.menus_db,
+                                                         'unique_restaurants': self._unique_restaurants})
+        self._update_totals()
+
+    def _update_totals(self):
+        self.num_restaurants = self._unique_restaurants.shape[0]
+        self.total_revenue = self._unique_restaurants['revenue'].sum()
+        self.total_sales = self._unique_restaurants['month_sales'].sum()
+        self._spatial_index = None
+
+    def _prepare(self, lon, lat, range):
+        """
+        从数据库读取数据并计算营业额, 平均价格, 商家分类和菜品种类
+        """
         print('加载数据库', self.db_file, '...')
         print('----------------------------------------------')
-        engine = sqlalchemy.create_engine('sqlite:///' + self.db_file)
-        self.restaurants_db = pd.read_sql_table('restaurants', engine)
+        tables = loader.load_tables(self.db_file)
+        self.restaurants_db = tables['restaurants']
         print('商家数(独立):\t', self.restaurants_db.shape[0])
-        self.menus_db = pd.read_sql_table('menus', engine)
+        self.menus_db = tables['menus']
         print('菜单数:\t\t', self.menus_db.shape[0])
-        category_db = pd.read_sql_table('category', engine)
-        restaurant_categories_db = pd.read_sql_table('restaurant_categories', engine)
+        category_db = tables['category']
+        restaurant_categories_db = tables['restaurant_categories']
         print('商家数(分类):\t', restaurant_categories_db.shape[0])
         print('----------------------------------------------')
 
         if lon is not None and lat is not None and range is not None:
             print("排除范围外的商家")
-            self.restaurants_db = self.restaurants_db[self.restaurants_db.apply(
-                lambda x: Analyzer.calcDistance(x['latitude'], x['longitude'], lat, lon) <= range, axis=1)]
+            distance = spatial.calc_distance_array(self.restaurants_db['latitude'].values,
+                                                   self.restaurants_db['longitude'].values, lat, lon)
+            self.restaurants_db = self.restaurants_db[distance <= range]
             print("排除后商家数(独立):\t", self.restaurants_db.shape[0])
 
         print('丢弃菜单重复数据')
@@ -108,9 +238,9 @@ class Analyzer(object):
         self.restaurants_db['revenue'] = self.restaurants_db['revenue'].fillna(0)
         del self.restaurants_db['restaurant_id']
 
-        self.num_restaurants = self.restaurants_db.shape[0]
-        self.total_revenue = self.restaurants_db['revenue'].sum()
-        self.total_sales = self.restaurants_db['month_sales'].sum()
+        # 每个商家一行, 空间查询在这张表上进行
+        self._unique_restaurants = self.restaurants_db.loc[:, ['id', 'latitude', 'longitude', 'revenue',
+                                                              'month_sales']].reset_index(drop=True)
 
         print('合并商家类型...')
         self.restaurants_db = pd.merge(self.restaurants_db, restaurant_categories_db, left_on='id',
@@ -122,19 +252,57 @@ class Analyzer(object):
         self.restaurants_db = pd.merge(self.restaurants_db, category_db, left_on='category_id', right_on='cat_id',
                                        how='left')
         print('为菜单生成种类分类信息...')
-        self.menus_db['type'] = [self._determine_dish_type(n) for n in self.menus_db['name']]
+        self.menus_db['type'] = DishClassifier().classify(self.menus_db['name'])
 
         print('为菜单生成商铺分类信息...')
         category_db = self.restaurants_db.loc[:, ['id', 'cat_name']].rename(columns={'id': 'restaurant_id'})
         self.menus_db = pd.merge(self.menus_db, category_db, on='restaurant_id')
 
-    @staticmethod
-    def _determine_dish_type(name):
-        for type, keywords in _DISK_CATEGORY_KEYWORDS.items():
-            for keyword in keywords:
-                if keyword in name:
-                    return type
-        return 'vegetable'
+    @property
+    def spatial_index(self):
+        if self._spatial_index is None:
+            self._spatial_index = spatial.GridIndex(self._unique_restaurants['latitude'].values,
+                                                    self._unique_restaurants['longitude'].values)
+        return self._spatial_index
+
+    def _restaurant_ids(self, positions):
+        return self._unique_restaurants['id'].values[positions]
+
+    def restaurants_within(self, lat, lon, radius):
+        """
+        :param radius: 半径(km)
+        :return: 范围内商家的行(每个分类一行)
+        """
+        positions, distance = self.spatial_index.radius(lat, lon, radius)
+        return self.restaurants_db[self.restaurants_db['id'].isin(self._restaurant_ids(positions))]
+
+    def restaurants_in_bbox(self, min_lat, min_lon, max_lat, max_lon):
+        positions = self.spatial_index.bbox(min_lat, min_lon, max_lat, max_lon)
+        return self.restaurants_db[self.restaurants_db['id'].isin(self._restaurant_ids(positions))]
+
+    def nearest_restaurants(self, lat, lon, k):
+        """
+        :return: 最近的k个商家的行(每个分类一行), 按距离排序, distance为距离(km)
+        """
+        positions, distance = self.spatial_index.knn(lat, lon, k)
+        distance_df = pd.DataFrame({'id': self._restaurant_ids(positions), 'distance': distance})
+        return pd.merge(distance_df, self.restaurants_db, on='id').sort_values(by='distance', kind='mergesort')
+
+    def area(self, name, lat, lon, radius):
+        """
+        同一次抓取中的一个商圈, 返回的Analyzer只包含范围内的商家和菜单, generate生成的文件名带有name
+        :param radius: 半径(km)
+        """
+        positions, distance = self.spatial_index.radius(lat, lon, radius)
+        ids = self._restaurant_ids(positions)
+
+        analyzer = copy.copy(self)
+        analyzer.db_name = '{}-{}'.format(self.db_name, name)
+        analyzer.restaurants_db = self.restaurants_db[self.restaurants_db['id'].isin(ids)].copy()
+        analyzer.menus_db = self.menus_db[self.menus_db['restaurant_id'].isin(ids)].copy()
+        analyzer._unique_restaurants = self._unique_restaurants.iloc[positions].reset_index(drop=True)
+        analyzer._update_totals()
+        return analyzer
 
     @staticmethod
     def _check_row_count(df, needed):
@@ -147,63 +315,55 @@ class Analyzer(object):
             return df
 
     @staticmethod
-    def _merge_dishes(df, order_by):
-        output_df = df.loc[:, ['name', order_by]]
-        output_df = output_df.groupby('name').sum().sort_values(by=order_by, ascending=False).reset_index(drop=False)
-        return output_df
+    def _top_by_group(df, key, groups, order_by, size, columns):
+        """
+        每个分组按order_by取前size行, 分组按groups的顺序排列, 不足size行的分组用空行补齐
+        :param key: 分组的列
+        :param columns: 输出的列
+        :return: len(groups) * size 行
+        """
+        groups = pd.Index(groups)
+        df = df[df[key].isin(groups)].sort_values(by=order_by, ascending=False, kind='mergesort')
+        df = df.groupby(key, observed=True, sort=False).head(size)
+        rank = df.groupby(key, observed=True, sort=False).cumcount().values
+        position = groups.get_indexer(df[key]) * size + rank
 
-    def _generate_restaurant_ranking_by_categories(self, category_df, restaurants_db):
-        def _generate_by_category(df, cat_name, order_by, ranking_list_size):
-            column_name_map = {'name': '2.1 店铺名', 'rating_count': '2.2 点评数', 'month_sales': '2.3 月销量',
-                               'revenue': '2.4 营业额'}
-
-            df = df[df['cat_name'] == cat_name].loc[:,
-                 ['name', 'rating_count', 'month_sales', 'revenue']].sort_values(by=order_by, ascending=False).iloc[
-                 0:ranking_list_size].rename(columns=column_name_map).reset_index(drop=True)
-            df = self._check_row_count(df, self.ranking_list_size)
-            return df
+        df = df.loc[:, columns]
+        df.index = position
+        return df.reindex(range(0, len(groups) * size))
 
-        df = pd.DataFrame()
-        for cat_name in category_df['1.0 菜系品类']:
-            ranking_df = _generate_by_category(restaurants_db, cat_name, self.order_by, self.ranking_list_size)
-            df = pd.concat([df, ranking_df], ignore_index=True)
-        df.reset_index(drop=True)
-        return df
+    def _generate_restaurant_ranking_by_categories(self, category_df, restaurants_db):
+        column_name_map = {'name': '2.1 店铺名', 'rating_count': '2.2 点评数', 'month_sales': '2.3 月销量',
+                           'revenue': '2.4 营业额'}
+        df = self._top_by_group(restaurants_db, 'cat_name', category_df['1.0 菜系品类'], self.order_by,
+                                self.ranking_list_size, ['name', 'rating_count', 'month_sales', 'revenue'])
+        return df.rename(columns=column_name_map)
 
-    def _generate_menu_ranking_by_categories(self, category_df, menus_db, dish_type, columns):
+    def _generate_menu_ranking_by_categories(self, category_df, cube, band, dish_type, columns):
         """
         生成菜单的排行榜
         :param category_df: 商家的分类
+        :param band: 价格范围, 见ReportCube
         :param dish_type: 菜品的类型
         :param columns: 列名
         :return: 菜单排行榜
         """
-
-        def _generate_by_category(order_by, ranking_list_size):
-            df = menus_db[(menus_db.cat_name == cat_name) & (menus_db.type == dish_type)]
-
-            # 合并菜品
-            df = self._merge_dishes(df, order_by).iloc[0:ranking_list_size].reset_index(drop=True)
-            df = self._check_row_count(df, ranking_list_size)
-            df.columns = columns
-            return df
-
-        df = pd.DataFrame()
-        for cat_name in category_df['1.0 菜系品类']:
-            ranking_df = _generate_by_category(self.order_by, self.ranking_list_size)
-            df = pd.concat([df, ranking_df], ignore_index=True)
-        df.reset_index(drop=True)
+        totals = cube.dish_totals[band]
+        dishes = totals[totals.index.get_level_values('type') == dish_type].reset_index(drop=False)
+        df = self._top_by_group(dishes, 'cat_name', category_df['1.0 菜系品类'], self.order_by,
+                                self.ranking_list_size, ['name', self.order_by])
+        df.columns = columns
         return df
 
-    def _generate_category_ranking(self, restaurants_db, size=None, expandable=True):
+    def _generate_category_ranking(self, cube, band=None, size=None, expandable=True):
         """
         根据当前的排序生成根据商铺分类排行的总表
         :param size: 返回数量
         :param expandable: 是否将每一条纪录复制N条
         :return: 商铺的分类排行榜
         """
-        df = restaurants_db.loc[:, ['cat_name', 'rating_count', 'month_sales', 'revenue']].groupby(
-            'cat_name').sum().sort_values(by=self.order_by, ascending=False).reset_index(drop=False)
+        df = cube.category_totals[band].loc[:, _ORDER_BY_KEYWORD].sort_values(
+            by=self.order_by, ascending=False).reset_index(drop=False)
         df.columns = ['1.0 菜系品类', '1.1 点评数', '1.1 月销量', '1.1 营业额']
 
         if size is not None:
@@ -225,23 +385,16 @@ class Analyzer(object):
         df = pd.DataFrame(values, index=['商家数', '总营业额', '平均营业额/商家', '总销量(未做缩放)'])
         return df
 
-    def _generate_comprehensive_report(self, restaurants_db, menus_db, price_range=None):
+    def _generate_comprehensive_report(self, cube, band=None):
         """
         创建综合的报告
+        :param band: 价格范围, 见ReportCube
         :return: 生成的报告DataFrame
         """
-
-        restaurants_df = restaurants_db
-        menus_df = menus_db
-        if price_range is not None:
-            restaurants_df = restaurants_df[(restaurants_df[_AVERAGE_PRICE] >= price_range['low']) & (
-                restaurants_df[_AVERAGE_PRICE] <= price_range['high'])]
-            menus_df = menus_df[(menus_df['price'] >= price_range['low']) & (menus_df['price'] <= price_range['high'])]
-
-        df = self._generate_category_ranking(restaurants_df, size=self.ranking_list_size)
+        df = self._generate_category_ranking(cube, band, size=self.ranking_list_size)
 
         cat_df = df.drop_duplicates('1.0 菜系品类')
-        df = pd.concat([df, self._generate_restaurant_ranking_by_categories(cat_df, restaurants_df)], axis=1)
+        df = pd.concat([df, self._generate_restaurant_ranking_by_categories(cat_df, cube.restaurants[band])], axis=1)
 
         # 分品类
         name = _COLUMN_NAME_DICT[self.order_by]
@@ -254,11 +407,11 @@ class Analyzer(object):
         for dish_type in dish_types:
             df = pd.concat(
                 [df,
-                 self._generate_menu_ranking_by_categories(cat_df, menus_df, dish_type['cat'], dish_type['col'])],
+                 self._generate_menu_ranking_by_categories(cat_df, cube, band, dish_type['cat'], dish_type['col'])],
                 axis=1)
         return df
 
-    def _generate_restaurant_report(self, restaurant_db):
+    def _generate_restaurant_report(self, cube):
         print('生成商家报告...')
 
         def generate_restaurant_ranking(restaurant_db, order_by, restaurant_list_size):
@@ -271,14 +424,11 @@ class Analyzer(object):
             df = df.reindex_axis(['name', 'rating_count', 'month_sales', 'revenue', _AVERAGE_PRICE], axis=1)
             return df
 
-        df = generate_restaurant_ranking(restaurant_db, self.order_by, self.restaurant_list_size)
+        df = generate_restaurant_ranking(cube.restaurants[None], self.order_by, self.restaurant_list_size)
 
-        for pr in _PRICE_RANGES:
-            # print('生成商家报告({}-{})...'.format(pr['low'], pr['high']))
-            filter_df = restaurant_db[
-                (restaurant_db[_AVERAGE_PRICE] >= pr['low']) & (restaurant_db[_AVERAGE_PRICE] <= pr['high'])]
-            df = pd.concat([df, generate_restaurant_ranking(filter_df, self.order_by, self.restaurant_list_size)],
-                           axis=1)
+        for band in range(0, len(_PRICE_RANGES)):
+            df = pd.concat([df, generate_restaurant_ranking(cube.restaurants[band], self.order_by,
+                                                            self.restaurant_list_size)], axis=1)
         df.columns = ['店铺名', '点评数', '销量', '营业额', '平均售价',
                       '店铺名(<30)', '点评数(<30)', '销量(<30)', '营业额(<30)', '平均售价(<30)',
                       '店铺名(31-50)', '点评数(31-50)', '销量(31-50)', '营业额(<31-50)', '平均售价(<31-50)',
@@ -287,12 +437,10 @@ class Analyzer(object):
                       '店铺名(>120)', '点评数(>120)', '销量(>120)', '营业额(>120)', '平均售价(>120)']
         return df
 
-    def _generate_menu_report(self, menus_db):
+    def _generate_menu_report(self, cube):
         print('生成菜品报告...')
 
-        f = {'rating_count': 'sum', 'month_sales': 'sum', 'price': 'mean', 'revenue': 'sum'}
-        menus_df = menus_db.loc[:, ['name', 'rating_count', 'month_sales', 'price', 'revenue']].groupby('name').agg(
-            f).reindex_axis(['rating_count', 'month_sales', 'price', 'revenue'], axis=1)
+        menus_df = cube.menu_totals
 
         def generate_menu_ranking(menu_df, order_by, menu_list_size):
             output_df = menu_df.sort_values(by=order_by, ascending=False).iloc[0:menu_list_size].reset_index(drop=False)
@@ -317,7 +465,7 @@ class Analyzer(object):
                       '推荐菜(>120)', '点评数(>120)', '销量(>120)', '价格(>120)']
         return df
 
-    def _generate_restaurant_distribution(self, restaurant_db):
+    def _generate_restaurant_distribution(self, cube):
         print('生成商家分布报告...')
 
         order_by_name = _COLUMN_NAME_DICT[self.order_by]
@@ -328,70 +476,65 @@ class Analyzer(object):
                    {'cnt': '6.0 店铺数(81-120)', 'sum': '6.1 {}(81-120)'.format(order_by_name), 'avg': '6.1 平均(81-120)'},
                    {'cnt': '7.0 店铺数(>120)', 'sum': '7.1 {}(>120)'.format(order_by_name), 'avg': '7.1 平均(>120)'}]
 
-        def count_num_restaurants(cat_name, input_df, order_by, column):
-            restaurant_df = input_df[input_df.cat_name == cat_name]
-
-            num_restaurants = restaurant_df.shape[0]
-            sum_value = restaurant_df[order_by].sum()
-            average_value = (sum_value / num_restaurants) if num_restaurants != 0 else 0
+        def generate_distribution_by_category(band, order_by, column):
+            # 价格范围内没有商家的分类为0
+            totals = cube.category_totals[band].reindex(category_df['1.0 菜系品类'], fill_value=0)
+            num_restaurants = totals['count'].values
+            sum_value = totals[order_by].values
+            average_value = (totals[order_by] / totals['count']).fillna(0).values
 
             output_df = pd.DataFrame({
                 column['cnt']: num_restaurants,
                 column['sum']: sum_value,
                 column['avg']: average_value,
-            }, index=[0])
-            output_df = output_df.reindex_axis([column['cnt'], column['sum'], column['avg']], axis=1)
-            return output_df
-
-        def generate_distribution_by_category(input_df, order_by, column):
-            output_df = pd.DataFrame()
-            for idx, row in category_df.iterrows():
-                sum_df = count_num_restaurants(row['1.0 菜系品类'], input_df, order_by, column)
-                output_df = pd.concat([output_df, sum_df], ignore_index=True)
+            }, columns=[column['cnt'], column['sum'], column['avg']])
             return output_df
 
-        category_df = self._generate_category_ranking(restaurant_db, size=self.ranking_list_size, expandable=False)
-        dist = generate_distribution_by_category(restaurant_db, self.order_by, columns[0])
+        category_df = self._generate_category_ranking(cube, size=self.ranking_list_size, expandable=False)
+        dist = generate_distribution_by_category(None, self.order_by, columns[0])
         dist = pd.concat([category_df, dist], axis=1)
 
-        column_index = 1
-        for pr in _PRICE_RANGES:
-            # print('生成商家分布报告({}-{})...'.format(pr['low'], pr['high']))
-            df = restaurant_db[
-                (restaurant_db[_AVERAGE_PRICE] >= pr['low']) & (restaurant_db[_AVERAGE_PRICE] <= pr['high'])]
-            df = generate_distribution_by_category(df, self.order_by, columns[column_index])
-            column_index += 1
+        for band in range(0, len(_PRICE_RANGES)):
+            df = generate_distribution_by_category(band, self.order_by, columns[band + 1])
             dist = pd.concat([dist, df], axis=1)
 
         return dist
 
-    def _create_excel(self, excel_filename):
+    def _generate_reports(self, cube):
         """
-        生成EXCEL文件
-        :param excel_filename: EXCEL文件名
-        :return: None
+        按工作表的顺序逐个生成报告
+        :return: (工作表名, DataFrame)的生成器
         """
         sheet_names = ['Summary', '汇总', '<30', '31 - 50', '51 = 80', '81 - 120', '>121', '商家', '菜单', '分布']
 
-        reports = []
-        print('----------------------------------------------')
-        print('生成Excel:\t', excel_filename)
         print('生成分类总榜...')
-        reports.append(self._generate_summary(self.restaurants_db))
-        reports.append(self._generate_comprehensive_report(self.restaurants_db, self.menus_db))
+        yield sheet_names[0], self._generate_summary(self.restaurants_db)
+        yield sheet_names[1], self._generate_comprehensive_report(cube)
 
         # 生成所有的价格分榜单
-        for price_range in _PRICE_RANGES:
-            # print('生成分类榜({}-{})...'.format(price_range['low'], price_range['high']))
-            reports.append(self._generate_comprehensive_report(self.restaurants_db, self.menus_db, price_range))
+        for band in range(0, len(_PRICE_RANGES)):
+            yield sheet_names[band + 2], self._generate_comprehensive_report(cube, band)
 
-        reports.append(self._generate_restaurant_report(self.restaurants_db))
-        reports.append(self._generate_menu_report(self.menus_db))
-        reports.append(self._generate_restaurant_distribution(self.restaurants_db))
+        yield sheet_names[7], self._generate_restaurant_report(cube)
+        yield sheet_names[8], self._generate_menu_report(cube)
+        yield sheet_names[9], self._generate_restaurant_distribution(cube)
 
-        with ExcelWriter(excel_filename) as writer:
-            for idx in range(len(reports)):
-                reports[idx].to_excel(writer, sheet_names[idx])
+    def _create_report(self, base_name, cube=None, report_format='excel'):
+        """
+        生成报告文件, 每个工作表生成后立即写入
+        :param base_name: 不带扩展名的文件名
+        :param cube: 当前数据的ReportCube, None时重新计算
+        :param report_format: 见report_sink.SINKS
+        :return: None
+        """
+        if cube is None:
+            cube = ReportCube(self.restaurants_db, self.menus_db)
+
+        with report_sink.SINKS[report_format](base_name) as sink:
+            print('----------------------------------------------')
+            print('生成报告:\t', sink.path)
+            for sheet_name, df in self._generate_reports(cube):
+                sink.write(sheet_name, df)
 
     def _scale(self):
         """
@@ -406,14 +549,99 @@ class Analyzer(object):
                 self.restaurants_db.loc[self.restaurants_db.cat_name == cat, col] = self.restaurants_db.loc[
                                                                                         self.restaurants_db.cat_name == cat, col] * self.scaling
 
-    def generate(self):
+    def generate(self, report_format='excel', num_processing=1):
+        """
+        :param report_format: 见report_sink.SINKS
+        :param num_processing: 大于1时在进程池中并行生成报告文件(需要pyarrow)
+        """
+        if num_processing > 1:
+            if cache.feather is not None:
+                self._generate_parallel(report_format, num_processing)
+                return
+            print('没有安装pyarrow, 不能并行生成报告, 按顺序生成')
+
+        # 三种排序共用同一份聚合结果, 缩放后只重新计算商家的部分
+        cube = ReportCube(self.restaurants_db, self.menus_db)
         for order_by in _ORDER_BY_KEYWORD:
             self.order_by = order_by
-            self._create_excel('{}-{}.xlsx'.format(self.db_name, _COLUMN_NAME_DICT[self.order_by]))
+            self._create_report('{}-{}'.format(self.db_name, _COLUMN_NAME_DICT[self.order_by]), cube, report_format)
 
         print('=====================================')
         self._scale()
+        cube.update_restaurants(self.restaurants_db)
 
         for order_by in _ORDER_BY_KEYWORD:
             self.order_by = order_by
-            self._create_excel('{}-{}-缩放.xlsx'.format(self.db_name, _COLUMN_NAME_DICT[self.order_by]))
+            self._create_report('{}-{}-缩放'.format(self.db_name, _COLUMN_NAME_DICT[self.order_by]), cube,
+                                report_format)
+
+    def _generate_parallel(self, report_format, num_processing):
+        """
+        每个报告文件由进程池中的一个进程生成. 准备好的商家, 缩放后的商家和菜品的聚合结果写成不压缩的feather文件,
+        各个进程以只读的内存映射读取, 不需要把DataFrame序列化后发送给每个进程.
+        菜品的聚合结果与缩放和排序无关, 只在这里计算一次
+        """
+        with tempfile.TemporaryDirectory(prefix='analyzer-') as directory:
+            frames = _totals_frames(_menu_totals(self.menus_db))
+            frames.update({'restaurants': self.restaurants_db, 'unique_restaurants': self._unique_restaurants})
+            cache.write_frames(directory, _SHARED_FRAMES_KEY, frames)
+            self._scale()
+            cache.write_frames(directory, _SHARED_FRAMES_KEY, {'scaled_restaurants': self.restaurants_db})
+
+            tasks = []
+            for restaurants_name, suffix in (('restaurants', ''), ('scaled_restaurants', '-缩放')):
+                for order_by in _ORDER_BY_KEYWORD:
+                    settings = dict((name, getattr(self, name)) for name in _REPORT_SETTINGS)
+                    settings['order_by'] = order_by
+                    base_name = '{}-{}{}'.format(self.db_name, _COLUMN_NAME_DICT[order_by], suffix)
+                    tasks.append((self.db_name, directory, restaurants_name, settings, base_name, report_format))
+
+            with _PROCESS_CONTEXT.Pool(min(num_processing, len(tasks))) as pool:
+                pool.map(_generate_report_file, tasks, chunksize=1)
+
+
+def _band_frame_name(band):
+    return 'dish_totals-{}'.format('all' if band is None else band)
+
+
+def _totals_frames(totals):
+    """
+    把_menu_totals的结果转换成可以写入feather文件的DataFrame(索引变成列)
+    :return: {名称: DataFrame}
+    """
+    dish_totals, menu_totals = totals
+    frames = dict((_band_frame_name(band), df.reset_index()) for band, df in dish_totals.items())
+    frames['menu_totals'] = menu_totals.reset_index()
+    return frames
+
+
+def _frames_totals(frames):
+    """
+    _totals_frames的逆转换
+    """
+    dish_totals = dict((band, frames[_band_frame_name(band)].set_index(['cat_name', 'type', 'name']))
+                       for band in _BANDS)
+    return dish_totals, frames['menu_totals'].set_index('name')
+
+
+def _generate_report_file(task):
+    """
+    进程池中生成一个报告文件
+    :param task: (db_name, 共享数据目录, 商家数据名, 报告属性, 文件名, 报告格式)
+    """
+    db_name, directory, restaurants_name, settings, base_name, report_format = task
+    names = [restaurants_name, 'unique_restaurants', 'menu_totals'] + [_band_frame_name(band) for band in _BANDS]
+    frames = cache.load_frames(directory, _SHARED_FRAMES_KEY, names, read_only=True)
+
+    analyzer = Analyzer.__new__(Analyzer)
+    analyzer.db_name = db_name
+    analyzer.db_file = db_name + '-data.db'
+    for name, value in settings.items():
+        setattr(analyzer, name, value)
+    analyzer.restaurants_db = frames[restaurants_name]
+    # 报告只用到菜品的聚合结果, 不需要读取菜单
+    analyzer.menus_db = None
+    analyzer._unique_restaurants = frames['unique_restaurants']
+    analyzer._update_totals()
+    analyzer._create_report(base_name, ReportCube(analyzer.restaurants_db, totals=_frames_totals(frames)),
+                            report_format)
@@ -1 +1 @@
-__all__ = ['db_utils']
\ No newline at end of file
+__all__ = ['db_utils', 'data_writer', 'log_sink', 'geo_grid']
\ No newline at end of file
@@ -0,0 +1,249 @@
+import multiprocessing
+import queue
+import sys
+import time
+import traceback
+
+from dbutils import db_utils
+
+_DEFAULT_MAX_BATCH_ROWS = 20000
+_DEFAULT_FLUSH_INTERVAL = 1.0
+_DEFAULT_QUEUE_SIZE = 1024
+
+# 队列满时每次等待的秒数, 超时后检查写入进程是否还在运行
+_PUT_TIMEOUT = 1.0
+
+# sqlite连接在fork后不能继续使用, 父进程中尚未被回收的连接会破坏子进程的WAL锁状态,
+# 写入进程用spawn启动, 不继承父进程的sqlite状态
+_PROCESS_CONTEXT = multiprocessing.get_context('spawn')
+
+# 抓取器写入商家数据库时使用的语句
+STATEMENTS = {
+    'restaurants': '''
+        INSERT OR IGNORE INTO restaurants VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+        ''',
+    'restaurants_upsert': '''
+        INSERT INTO restaurants VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+        ON CONFLICT(id) DO UPDATE SET name = excluded.name, name_for_url = excluded.name_for_url,
+            rating = excluded.rating, rating_count = excluded.rating_count, month_sales = excluded.month_sales,
+            phone = excluded.phone, latitude = excluded.latitude, longitude = excluded.longitude,
+            is_free_delivery = excluded.is_free_delivery, delivery_fee = excluded.delivery_fee,
+            minimum_order_amount = excluded.minimum_order_amount,
+            minimum_free_delivery_amount = excluded.minimum_free_delivery_amount,
+            promotion_info = excluded.promotion_info, address = excluded.address
+        WHERE (restaurants.name, restaurants.name_for_url, restaurants.rating, restaurants.rating_count,
+               restaurants.month_sales, restaurants.phone, restaurants.latitude, restaurants.longitude,
+               restaurants.is_free_delivery, restaurants.delivery_fee, restaurants.minimum_order_amount,
+               restaurants.minimum_free_delivery_amount, restaurants.promotion_info, restaurants.address)
+            IS NOT (excluded.name, excluded.name_for_url, excluded.rating, excluded.rating_count,
+                    excluded.month_sales, excluded.phone, excluded.latitude, excluded.longitude,
+                    excluded.is_free_delivery, excluded.delivery_fee, excluded.minimum_order_amount,
+                    excluded.minimum_free_delivery_amount, excluded.promotion_info, excluded.address)
+        ''',
+    'crawl_seen': '''
+        INSERT OR IGNORE INTO crawl_seen(id) VALUES(?)
+        ''',
+    'restaurant_categories': '''
+        INSERT OR IGNORE INTO restaurant_categories(category_id,restaurant_id) VALUES(?,?)
+        ''',
+    'restaurant_cells': '''
+        INSERT OR IGNORE INTO restaurant_cells(restaurant_id,geohash) VALUES(?,?)
+        ''',
+    'menus': '''
+        INSERT INTO menus(restaurant_id,name,pinyin_name,rating,rating_count,price,month_sales,description,category_id)
+        VALUES(?,?,?,?,?,?,?,?,?)
+        ''',
+    'delete_menus': '''
+        DELETE FROM menus WHERE restaurant_id = ?
+        ''',
+    'menu_versions': '''
+        INSERT INTO menu_versions(restaurant_id,fingerprint,etag,last_modified,commit_date)
+        VALUES(?,?,?,?,datetime('now','localtime'))
+        ON CONFLICT(restaurant_id) DO UPDATE SET fingerprint = excluded.fingerprint, etag = excluded.etag,
+            last_modified = excluded.last_modified, commit_date = excluded.commit_date
+        ''',
+    'touch_menu_versions': '''
+        UPDATE menu_versions SET etag = COALESCE(?, etag), last_modified = COALESCE(?, last_modified),
+            commit_date = datetime('now','localtime')
+        WHERE restaurant_id = ?
+        ''',
+}
+
+
+def _execute_batches(cursor, batches):
+    for statement, rows in batches:
+        if len(rows) != 0:
+            cursor.executemany(STATEMENTS[statement], rows)
+
+
+class DirectWriter(object):
+    """
+    在调用线程中直接写入商家数据库, 每次write为一个事务
+    """
+
+    def __init__(self, db_name):
+        self.db_name = db_name
+        with db_utils.connect_database(db_name) as conn:
+            db_utils.migrate_data_table(conn)
+
+    def write(self, batches):
+        """
+        :param batches: [(语句名, 行列表), ...], 按顺序执行
+        """
+        with db_utils.connect_database(self.db_name) as conn:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN')
+            _execute_batches(cursor, batches)
+            conn.commit()
+
+
+class DataWriterError(RuntimeError):
+    """
+    写入进程异常退出, committed_until之后放入队列的数据没有写入数据库
+    """
+
+    def __init__(self, message, committed_until):
+        super().__init__(message)
+        self.committed_until = committed_until
+
+
+class QueueWriter(object):
+    """
+    把数据发给DataWriterProcess, 抓取器不会等待数据库锁
+    """
+
+    def __init__(self, data_queue, exit_reader):
+        """
+        :param exit_reader: 写入进程持有另一端的管道, 写入进程退出后可读(EOF)
+        """
+        self._queue = data_queue
+        self._exit_reader = exit_reader
+
+    def _check_writer(self):
+        if self._exit_reader.poll():
+            # 写入进程不会再读取队列, 不等待缓冲中的数据发送完成就可以退出
+            self._queue.cancel_join_thread()
+            raise DataWriterError('写入进程已退出', None)
+
+    def write(self, batches):
+        """
+        :raise DataWriterError: 写入进程已退出, 调用者不能把对应的任务标记为完成
+        """
+        self._check_writer()
+        item = (time.time(), batches)
+        while True:
+            try:
+                self._queue.put(item, timeout=_PUT_TIMEOUT)
+                return
+            except queue.Full:
+                self._check_writer()
+
+
+def _writer_loop(db_name, data_queue, max_batch_rows, flush_interval, exit_writer, committed_until):
+    """
+    :param exit_writer: 进程退出时由系统关闭, QueueWriter据此判断写入进程是否还在运行
+    :param committed_until: 共享内存, 已提交的数据中最后一批放入队列的时间
+    """
+    try:
+        _write_batches(db_name, data_queue, max_batch_rows, flush_interval, committed_until)
+    except Exception:
+        traceback.print_exc()
+        print('\n写入进程出错, %s之后放入队列的数据没有写入' %
+              time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(committed_until.value)))
+        sys.exit(1)
+
+
+def _write_batches(db_name, data_queue, max_batch_rows, flush_interval, committed_until):
+    conn = db_utils.connect_database(db_name)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    db_utils.migrate_data_table(conn)
+    cursor = conn.cursor()
+
+    num_rows = 0
+    num_commits = 0
+    pending_rows = 0
+    write_time = 0.0
+    last_commit = time.monotonic()
+    last_put = committed_until.value
+    running = True
+
+    while running:
+        try:
+            item = data_queue.get(timeout=flush_interval)
+        except queue.Empty:
+            item = (last_put, [])
+
+        if item is None:
+            running = False
+        else:
+            last_put, batches = item
+            if len(batches) != 0:
+                start = time.monotonic()
+                if not conn.in_transaction:
+                    cursor.execute('BEGIN')
+                _execute_batches(cursor, batches)
+                write_time += time.monotonic() - start
+                rows = sum(len(rows) for statement, rows in batches)
+                pending_rows += rows
+                num_rows += rows
+
+        if conn.in_transaction and (not running or pending_rows >= max_batch_rows or
+                                    time.monotonic() - last_commit >= flush_interval):
+            start = time.monotonic()
+            conn.commit()
+            write_time += time.monotonic() - start
+            num_commits += 1
+            pending_rows = 0
+            last_commit = time.monotonic()
+            committed_until.value = last_put
+
+    conn.close()
+    print('\n写入进程结束: %d行 %d次提交 写入耗时%.2fs %.0f行/s' %
+          (num_rows, num_commits, write_time, num_rows / write_time if write_time > 0 else 0))
+
+
+class DataWriterProcess(object):
+    """
+    商家数据库的唯一写入进程, 在WAL模式下把收到的数据合并成大事务提交
+    """
+
+    def __init__(self, db_name, max_batch_rows=_DEFAULT_MAX_BATCH_ROWS, flush_interval=_DEFAULT_FLUSH_INTERVAL,
+                 queue_size=_DEFAULT_QUEUE_SIZE):
+        self.db_name = db_name
+        self.max_batch_rows = max_batch_rows
+        self.flush_interval = flush_interval
+        self._queue = _PROCESS_CONTEXT.Queue(queue_size)
+        self._committed_until = _PROCESS_CONTEXT.Value('d', 0.0, lock=False)
+        self._exit_reader = None
+        self._process = None
+
+    def start(self):
+        # 启动之前的数据已经由之前的写入进程提交
+        self._committed_until.value = time.time()
+        self._exit_reader, exit_writer = _PROCESS_CONTEXT.Pipe(duplex=False)
+        self._process = _PROCESS_CONTEXT.Process(target=_writer_loop,
+                                               args=(self.db_name, self._queue, self.max_batch_rows,
+                                                     self.flush_interval, exit_writer, self._committed_until))
+        self._process.start()
+        # 只有写入进程持有管道的写端
+        exit_writer.close()
+
+    def client(self):
+        return QueueWriter(self._queue, self._exit_reader)
+
+    def stop(self):
+        """
+        :raise DataWriterError: 写入进程异常退出
+        """
+        while self._process.is_alive():
+            try:
+                self._queue.put(None, timeout=_PUT_TIMEOUT)
+                break
+            except queue.Full:
+                pass
+        self._process.join()
+        if self._process.exitcode != 0:
+            self._queue.cancel_join_thread()
+            raise DataWriterError('写入进程异常退出(exitcode=%d)' % self._process.exitcode,
+                                  self._committed_until.value)
@@ -1,11 +1,12 @@
 import datetime
+import os
 import sqlite3
-import sys
-from itertools import *
 
-import geohash
+from dbutils import geo_grid
+from fetcher import worker
 
-from fetcher import *
+# 写入进程异常退出时, 在最后一次提交之前这么多秒内完成的任务也重新抓取
+_UNCONFIRMED_MARGIN = 5.0
 
 MAJOR_CATEGORY_TEXT = {
     207: '全部快餐类',
@@ -54,75 +55,35 @@ MINOR_CATEGORY_TEXT = {
 }
 
 
-class _MapGridIterator():
-    def __init__(self, central, depth=65):
-        self._cells = set()
-        self._next_batch = set([central])
-        self._computed_cells = set()
-        self.max_depth = depth
-        self.current_depth = 0
-        self._refresh_output()
-
-    def __iter__(self):
-        return self
-
-    def __next__(self):
-        cell = self._next_cell()
-        if cell is None:
-            raise StopIteration
-        return cell,
-
-    def _add_neighbors(self, cell):
-        if cell in self._computed_cells:
-            return
-
-        n = geohash.neighbors(cell)
-
-        def cond(c): return (c in self._computed_cells) or (c in self._cells)
-
-        n[:] = list(filterfalse(cond, n))
-
-        self._next_batch.update(n)
-        self._computed_cells.add(cell)
-
-    def _advance_depth(self):
-        self._cells = self._next_batch
-        self._next_batch = set()
-        self.current_depth += 1
-        self._refresh_output()
-
-    def _take_cell(self):
-        if len(self._cells) == 0:
-            return None
-        cell = self._cells.pop()
-        self._add_neighbors(cell)
-        return cell
-
-    def _refresh_output(self):
-        sys.stdout.write("\r创建地图网格(深度:%d) %.2f%%" % (self.max_depth, self.current_depth / self.max_depth * 100.0))
-        sys.stdout.flush()
-
-    def _next_cell(self):
-        if len(self._cells) == 0 and self.current_depth < self.max_depth:
-            self._advance_depth()
-
-        return self._take_cell()
-
-
-def _create_status_table(conn, central, depth):
+def _grid_cells(central, depth, precision=None, polygon=None, radius=None):
     """
-    Create geohash-grid table
+    :param depth: 正方形网格深度, 指定polygon/radius时可以为None
+    :param precision: 自适应网格的初始精度, 网格由覆盖同一区域的粗粒度geohash组成. None为与central相同
+    :param polygon: [[纬度, 经度], ...], 只创建与多边形相交的网格
+    :param radius: 只创建与以central为圆心, radius公里为半径的圆相交的网格
     """
-    cursor = conn.cursor()
+    if polygon is None and radius is None:
+        cells = geo_grid.square_grid(central, depth)
+    else:
+        cells = geo_grid.bounded_grid(central, depth, polygon, radius)
+    if precision is not None and precision < len(central):
+        cells = geo_grid.coarse_grid(cells, precision)
+    return cells
+
+
+def _create_status_schema(cursor):
     cursor.executescript('''
         DROP TABLE IF EXISTS grid;
         CREATE TABLE grid
             (
-            geohash CHARACTER(7) PRIMARY KEY NOT NULL,
+            geohash VARCHAR(12) PRIMARY KEY NOT NULL,
             fetch_status TINYINT DEFAULT 0,
-            commit_date DATETIME
+            commit_date DATETIME,
+            categories TEXT
             );
 
+        CREATE INDEX grid_fetch_status_idx ON grid(fetch_status);
+
         DROP TABLE IF EXISTS restaurants;
         CREATE TABLE restaurants
             (
@@ -130,18 +91,58 @@ def _create_status_table(conn, central, depth):
             fetch_status TINYINT DEFAULT 0,
             commit_date DATETIME
             );
+
+        CREATE INDEX restaurants_fetch_status_idx ON restaurants(fetch_status);
     ''')
 
-    grid_iter = _MapGridIterator(central, depth)
 
-    cursor.executemany('''INSERT INTO grid(geohash) VALUES (?);''', grid_iter)
+def _create_status_table(conn, central, depth, precision=None, polygon=None, radius=None):
+    """
+    Create geohash-grid table, 参数见_grid_cells
+    """
+    cursor = conn.cursor()
+    _create_status_schema(cursor)
+    cells = _grid_cells(central, depth, precision, polygon, radius)
+    cursor.executemany('''INSERT INTO grid(geohash) VALUES (?);''', ((cell,) for cell in cells.tolist()))
     conn.commit()
-    print('')
+    print('创建地图网格...完成 网格数:%d' % len(cells))
+
 
+_MENU_VERSIONS_TABLE = '''
+        CREATE TABLE IF NOT EXISTS menu_versions
+            (
+            restaurant_id INTEGER PRIMARY KEY NOT NULL,
+            fingerprint CHARACTER(40) NOT NULL,
+            etag TEXT,
+            last_modified TEXT,
+            commit_date DATETIME
+            );
+'''
 
-def _create_data_table(conn):
+
+_RESTAURANT_CELLS_TABLE = '''
+        CREATE TABLE IF NOT EXISTS restaurant_cells
+            (
+            restaurant_id INTEGER NOT NULL,
+            geohash VARCHAR(12) NOT NULL,
+            PRIMARY KEY(restaurant_id, geohash)
+            ) WITHOUT ROWID;
+'''
+
+
+def _create_data_table(conn, keep_menus=False):
+    """
+    :param keep_menus: 保留上一次抓取的menus和menu_versions, 未变化的菜单不会被重写
+    """
     cursor = conn.cursor()
+    if not keep_menus:
+        cursor.executescript('''
+            DROP TABLE IF EXISTS menus;
+            DROP TABLE IF EXISTS menu_versions;
+        ''')
+
     cursor.executescript('''
+        DROP TABLE IF EXISTS restaurant_cells;
         DROP TABLE IF EXISTS restaurants;
         CREATE TABLE restaurants
             (
@@ -162,8 +163,7 @@ def _create_data_table(conn):
             address TEXT
             );
 
-        DROP TABLE IF EXISTS menus;
-        CREATE TABLE menus
+        CREATE TABLE IF NOT EXISTS menus
             (
             id INTEGER PRIMARY KEY NOT NULL,
             restaurant_id INTEGER NOT NULL,
@@ -177,8 +177,8 @@ def _create_data_table(conn):
             category_id INTEGER
             );
 
-        CREATE INDEX restaurant_id_idx ON menus(restaurant_id);
-    ''')
+        CREATE INDEX IF NOT EXISTS restaurant_id_idx ON menus(restaurant_id);
+    ''' + _MENU_VERSIONS_TABLE)
     conn.commit()
     print('创建商家数据库...完成')
 
@@ -212,12 +212,44 @@ def _create_categery_table(conn):
             category_id INTEGER NOT NULL,
             restaurant_id INTEGER NOT NULL
             );
+
+        CREATE UNIQUE INDEX restaurant_categories_idx ON restaurant_categories(category_id, restaurant_id);
     ''')
     conn.commit()
     print('创建分类数据库...完成')
 
 
+def migrate_data_table(conn):
+    """
+    把旧版本创建的商家数据库升级到当前结构
+    """
+    conn.executescript(_MENU_VERSIONS_TABLE)
+    migrate_restaurant_categories(conn)
+
+
+def migrate_restaurant_categories(conn):
+    """
+    为旧数据库的restaurant_categories去重并建立唯一索引
+    """
+    row = conn.execute('''SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'restaurant_categories_idx'
+                       ''').fetchone()
+    if row is not None:
+        return
+
+    cursor = conn.cursor()
+    cursor.executescript('''
+        BEGIN;
+        DELETE FROM restaurant_categories WHERE rowid NOT IN
+            (SELECT MIN(rowid) FROM restaurant_categories GROUP BY category_id, restaurant_id);
+        CREATE UNIQUE INDEX restaurant_categories_idx ON restaurant_categories(category_id, restaurant_id);
+        COMMIT;
+    ''')
+
+
 def _create_log_table(conn):
+    """
+    相同的错误只保留一行, count为出现次数, error_message/exception最多保留512个字符
+    """
     cursor = conn.cursor()
     cursor.executescript('''
         DROP TABLE IF EXISTS fetch_restaurant_log;
@@ -225,35 +257,221 @@ def _create_log_table(conn):
             (
             geohash CHARACTER(7) NOT NULL,
             http_status_code SMALLINT NOT NULL,
-            error_message TEXT
+            error_message TEXT,
+            message_hash CHARACTER(16) NOT NULL,
+            count INTEGER DEFAULT 1
             );
+        CREATE UNIQUE INDEX fetch_restaurant_log_idx ON fetch_restaurant_log(geohash, http_status_code, message_hash);
 
         DROP TABLE IF EXISTS fetch_restaurant_exception;
         CREATE TABLE fetch_restaurant_exception
             (
             geohash CHARACTER(7) NOT NULL,
-            exception TEXT
+            exception TEXT,
+            message_hash CHARACTER(16) NOT NULL,
+            count INTEGER DEFAULT 1
             );
+        CREATE UNIQUE INDEX fetch_restaurant_exception_idx ON fetch_restaurant_exception(geohash, message_hash);
 
         DROP TABLE IF EXISTS fetch_menu_log;
         CREATE TABLE fetch_menu_log
             (
             restaurant_id INTEGER NOT NULL,
             http_status_code SMALLINT NOT NULL,
-            error_message TEXT
+            error_message TEXT,
+            message_hash CHARACTER(16) NOT NULL,
+            count INTEGER DEFAULT 1
             );
+        CREATE UNIQUE INDEX fetch_menu_log_idx ON fetch_menu_log(restaurant_id, http_status_code, message_hash);
 
         DROP TABLE IF EXISTS fetch_menu_exception;
         CREATE TABLE fetch_menu_exception
             (
             restaurant_id INTEGER NOT NULL,
-            exception TEXT
+            exception TEXT,
+            message_hash CHARACTER(16) NOT NULL,
+            count INTEGER DEFAULT 1
             );
+        CREATE UNIQUE INDEX fetch_menu_exception_idx ON fetch_menu_exception(restaurant_id, message_hash);
     ''')
     conn.commit()
     print('创建日志数据库...完成')
 
 
+def _reset_status_table(conn, refresh_age=None, refresh_limit=None):
+    """
+    增量抓取: 保留上一次的网格(包括自适应拆分出的子网格)和commit_date, 只重置需要重新抓取的网格.
+    失败和没有完成的网格总是需要重新抓取
+    :param refresh_age: 只重新抓取超过这么多小时没有抓取的网格, None为全部网格
+    :param refresh_limit: 最多重新抓取的网格数, 失败的网格和最久没有抓取的网格优先, None为不限制
+    """
+    if refresh_age is None:
+        condition, params = '1', ()
+    else:
+        condition = "fetch_status != 2 OR commit_date IS NULL OR commit_date < datetime('now','localtime',?)"
+        params = ('-{} hours'.format(refresh_age),)
+
+    cursor = conn.cursor()
+    cursor.executescript('''
+        CREATE INDEX IF NOT EXISTS grid_refresh_idx ON grid(fetch_status, commit_date);
+        BEGIN;
+        DELETE FROM restaurants;
+    ''')
+    cursor.execute('''UPDATE grid SET fetch_status = 0 WHERE geohash IN
+                      (SELECT geohash FROM grid WHERE {}
+                       ORDER BY fetch_status = 2, commit_date IS NOT NULL, commit_date LIMIT ?)'''.format(condition),
+                   params + (refresh_limit if refresh_limit is not None else -1,))
+    num_refresh = cursor.rowcount
+    conn.commit()
+    num_cells = cursor.execute('SELECT COUNT(*) FROM grid').fetchone()[0]
+    print('增量抓取: 重新抓取%d/%d个网格' % (num_refresh, num_cells))
+
+
+def _prepare_incremental_data_table(conn):
+    """
+    增量抓取: 保留上一次的商家和菜单数据, crawl_seen记录本次抓取到的商家, restaurant_cells记录商家所在的网格,
+    restaurant_changes由触发器记录新增(A)/变化(U)/下架(R)的商家,
+    crawl_info记录本次抓取之前的最后一条变化和本次抓取开始的时间
+    """
+    migrate_data_table(conn)
+    cursor = conn.cursor()
+    cursor.executescript('''
+        DROP TABLE IF EXISTS crawl_seen;
+        CREATE TABLE crawl_seen
+            (
+            id INTEGER PRIMARY KEY NOT NULL
+            );
+
+        CREATE TABLE IF NOT EXISTS restaurant_changes
+            (
+            restaurant_id INTEGER NOT NULL,
+            change CHARACTER(1) NOT NULL,
+            commit_date DATETIME
+            );
+
+        DROP TABLE IF EXISTS crawl_info;
+        CREATE TABLE crawl_info AS SELECT IFNULL(MAX(rowid), 0) AS last_change,
+            datetime('now','localtime') AS started FROM restaurant_changes;
+
+        CREATE TRIGGER IF NOT EXISTS restaurants_added AFTER INSERT ON restaurants
+        BEGIN
+            INSERT INTO restaurant_changes VALUES(new.id, 'A', datetime('now','localtime'));
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS restaurants_updated AFTER UPDATE ON restaurants
+        BEGIN
+            INSERT INTO restaurant_changes VALUES(new.id, 'U', datetime('now','localtime'));
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS restaurants_removed AFTER DELETE ON restaurants
+        BEGIN
+            INSERT INTO restaurant_changes VALUES(old.id, 'R', datetime('now','localtime'));
+        END;
+    ''' + _RESTAURANT_CELLS_TABLE)
+    conn.commit()
+    print('准备增量抓取商家数据库...完成')
+
+
+def _has_previous_run(db_names):
+    return os.path.exists(db_names['status']) and os.path.exists(db_names['data'])
+
+
+def _init_databases(db_names, create_status, keep_menus=False, incremental=False, refresh_age=None,
+                    refresh_limit=None):
+    """
+    :param create_status: 创建状态数据库的函数, 参数为数据库连接
+    :param incremental: 数据库已存在时以上一次的结果为基准增量抓取, 不存在时与全量抓取相同
+    :param refresh_age, refresh_limit: 增量抓取时重新抓取哪些网格, 见_reset_status_table
+    """
+    print('初始化数据库:\n状态数据:"{}"\n商家数据:"{}"\n日志数据:"{}"...'.format(
+            db_names['status'], db_names['data'], db_names['log']))
+    if incremental and _has_previous_run(db_names):
+        with connect_database(db_names['status']) as conn:
+            _reset_status_table(conn, refresh_age, refresh_limit)
+
+        with connect_database(db_names['data']) as conn:
+            _prepare_incremental_data_table(conn)
+    else:
+        with connect_database(db_names['status'], isolation_level='EXCLUSIVE') as conn:
+            create_status(conn)
+
+        with connect_database(db_names['data'], isolation_level='EXCLUSIVE') as conn:
+            _create_data_table(conn, keep_menus)
+            _create_categery_table(conn)
+
+        if incremental:
+            with connect_database(db_names['data']) as conn:
+                _prepare_incremental_data_table(conn)
+
+    with connect_database(db_names['log'], isolation_level='EXCLUSIVE') as conn:
+        _create_log_table(conn)
+
+
+def _num_failed_cells(db_names):
+    with connect_database(db_names['status']) as conn:
+        return conn.execute('SELECT COUNT(*) FROM grid WHERE fetch_status != 2').fetchone()[0]
+
+
+def prune_kept_menus(db_names):
+    """
+    保留上一次的菜单时(keep_menus), 商家表已经重建, 删除本次没有抓取到的商家的菜单和菜单版本.
+    有网格抓取失败时结果不完整, 不删除
+    """
+    with connect_database(db_names['data']) as conn:
+        stale = conn.execute('SELECT 1 FROM menus WHERE restaurant_id NOT IN (SELECT id FROM restaurants) '
+                             'LIMIT 1').fetchone()
+    if stale is None:
+        return
+
+    num_failed = _num_failed_cells(db_names)
+    if num_failed != 0:
+        print('\n%d个网格抓取失败, 不删除已下架商家的菜单' % num_failed)
+        return
+
+    with connect_database(db_names['data']) as conn:
+        cursor = conn.cursor()
+        cursor.execute('BEGIN')
+        cursor.execute('DELETE FROM menus WHERE restaurant_id NOT IN (SELECT id FROM restaurants)')
+        num_menus = cursor.rowcount
+        cursor.execute('DELETE FROM menu_versions WHERE restaurant_id NOT IN (SELECT id FROM restaurants)')
+        conn.commit()
+    print('\n删除已下架商家的菜单: %d个商家 %d条菜单' % (cursor.rowcount, num_menus))
+
+
+def finalize_incremental(db_names):
+    """
+    商家抓取完成后删除本次没有出现的商家及其分类和菜单.
+    所有网格都重新抓取成功时删除本次没有出现的全部商家; 有网格失败或没有重新抓取时结果不完整,
+    只删除上一次出现在本次成功抓取的网格中, 本次没有出现的商家
+    """
+    with connect_database(db_names['data']) as conn:
+        _attach(conn, db_names['status'], 'status')
+        num_failed, num_kept = conn.execute('''
+            SELECT TOTAL(fetch_status != 2), TOTAL(fetch_status = 2 AND commit_date < (SELECT started FROM crawl_info))
+            FROM status.grid''').fetchone()
+        if num_failed == 0 and num_kept == 0:
+            removed = 'SELECT id FROM restaurants WHERE id NOT IN (SELECT id FROM crawl_seen)'
+        else:
+            print('\n%d个网格抓取失败, %d个网格没有重新抓取, 只记录重新抓取的网格中下架的商家' % (num_failed, num_kept))
+            removed = '''SELECT c.restaurant_id FROM restaurant_cells c JOIN status.grid g ON g.geohash = c.geohash
+                         WHERE g.fetch_status = 2 AND g.commit_date >= (SELECT started FROM crawl_info)
+                         AND c.restaurant_id NOT IN (SELECT id FROM crawl_seen)'''
+
+        cursor = conn.cursor()
+        cursor.executescript('''
+            BEGIN;
+            DELETE FROM restaurants WHERE id IN ({});
+            DELETE FROM restaurant_categories WHERE restaurant_id NOT IN (SELECT id FROM restaurants);
+            DELETE FROM restaurant_cells WHERE restaurant_id NOT IN (SELECT id FROM restaurants);
+            DELETE FROM menus WHERE restaurant_id NOT IN (SELECT id FROM restaurants);
+            DELETE FROM menu_versions WHERE restaurant_id NOT IN (SELECT id FROM restaurants);
+            COMMIT;
+        '''.format(removed))
+        rows = dict(cursor.execute('''SELECT change,COUNT(*) FROM restaurant_changes
+                                      WHERE rowid > (SELECT last_change FROM crawl_info) GROUP BY change''').fetchall())
+    print('\n增量抓取完成: 新增%d 变化%d 下架%d' % (rows.get('A', 0), rows.get('U', 0), rows.get('R', 0)))
+
+
 def create_db_name_dict(date=None):
     date_part = date if date is not None else datetime.datetime.now().strftime("%Y-%m-%d")
     return {
@@ -264,61 +482,215 @@ def create_db_name_dict(date=None):
     }
 
 
-def create_database(central, depth):
+def create_database(central, depth, precision=None, keep_menus=False, incremental=False, polygon=None, radius=None,
+                    refresh_age=None, refresh_limit=None):
     db_names = create_db_name_dict()
-    print('初始化数据库:\n状态数据:"{}"\n商家数据:"{}"\n日志数据:"{}"...'.format(
-            db_names['status'], db_names['data'], db_names['log']))
-    with connect_database(db_names['status'], isolation_level='EXCLUSIVE') as conn:
-        _create_status_table(conn, central, depth)
+    _init_databases(db_names, lambda conn: _create_status_table(conn, central, depth, precision, polygon, radius),
+                    keep_menus, incremental, refresh_age, refresh_limit)
+    print('数据库初始化完成')
+    return db_names
 
-    with connect_database(db_names['data'], isolation_level='EXCLUSIVE') as conn:
-        _create_data_table(conn)
-        _create_categery_table(conn)
 
-    with connect_database(db_names['log'], isolation_level='EXCLUSIVE') as conn:
-        _create_log_table(conn)
+def create_database_sequence(centrals, depth, precision=None, keep_menus=False, incremental=False, polygon=None,
+                             radius=None, refresh_age=None, refresh_limit=None):
+    db_name_sequence = []
+    for central in centrals:
+        db_names = _central_db_names(central)
+        _init_databases(db_names, lambda conn: _create_status_table(conn, central, depth, precision, polygon, radius),
+                        keep_menus, incremental, refresh_age, refresh_limit)
+        db_name_sequence.append(db_names)
+    return db_name_sequence
 
-    print('数据库初始化完成')
+
+def _central_db_names(central):
+    return {
+        'date': datetime.datetime.now().strftime("%Y-%m-%d"),
+        'status': central + '-statuas.db',
+        'data': central + '-data.db',
+        'log': central + '-log.db'
+    }
+
+
+def _shared_db_names():
+    return {
+        'date': datetime.datetime.now().strftime("%Y-%m-%d"),
+        'status': 'shared-status.db',
+        'data': 'shared-data.db',
+        'log': 'shared-log.db'
+    }
+
+
+def _create_shared_status_table(conn, centrals, depth, precision=None, polygon=None, radius=None):
+    """
+    所有中心的网格合并成一张grid, 重叠的网格只抓取一次. grid_owners记录每个网格属于哪些中心
+    """
+    cursor = conn.cursor()
+    _create_status_schema(cursor)
+    cursor.executescript('''
+        DROP TABLE IF EXISTS grid_owners;
+        CREATE TABLE grid_owners
+            (
+            geohash VARCHAR(12) NOT NULL,
+            central VARCHAR(12) NOT NULL,
+            PRIMARY KEY(geohash, central)
+            ) WITHOUT ROWID;
+    ''')
+
+    num_cells = 0
+    for central in centrals:
+        cells = _grid_cells(central, depth, precision, polygon, radius).tolist()
+        cursor.executemany('INSERT OR IGNORE INTO grid(geohash) VALUES (?)', ((cell,) for cell in cells))
+        cursor.executemany('INSERT INTO grid_owners VALUES (?,?)', ((cell, central) for cell in cells))
+        num_cells += len(cells)
+    conn.commit()
+    num_unique = cursor.execute('SELECT COUNT(*) FROM grid').fetchone()[0]
+    print('创建共享地图网格...完成 网格数:%d(去重前%d)' % (num_unique, num_cells))
+
+
+def _create_restaurant_cells_table(conn):
+    """
+    记录每个商家是在哪些网格中抓取到的, 用于把共享抓取的结果分配给各个中心.
+    增量抓取时保留上一次的记录, 没有重新抓取的网格中的商家仍然可以分配
+    """
+    conn.executescript(_RESTAURANT_CELLS_TABLE)
+    conn.commit()
+
+
+def create_shared_database(centrals, depth, precision=None, keep_menus=False, incremental=False, polygon=None,
+                           radius=None, refresh_age=None, refresh_limit=None):
+    """
+    多个中心共用一组数据库和一次抓取, 完成后由distribute_shared_database写入各个中心的数据库
+    """
+    db_names = _shared_db_names()
+    _init_databases(db_names,
+                    lambda conn: _create_shared_status_table(conn, centrals, depth, precision, polygon, radius),
+                    keep_menus, incremental, refresh_age, refresh_limit)
+    with connect_database(db_names['data']) as conn:
+        _create_restaurant_cells_table(conn)
     return db_names
 
 
-def create_database_sequence(centrals, depth):
+def _attach(conn, db_name, alias):
+    conn.execute('ATTACH DATABASE ? AS {}'.format(alias), (db_name,))
+
+
+def distribute_shared_database(shared_names, centrals):
+    """
+    按grid_owners把共享抓取的网格, 商家, 分类, 菜单和抓取日志复制到各个中心的数据库(与逐个中心抓取的结构相同)
+    :return: 各个中心的db_names
+    """
+    with connect_database(shared_names['status']) as conn:
+        lengths = [row[0] for row in conn.execute('SELECT DISTINCT LENGTH(geohash) FROM grid_owners')]
+
     db_name_sequence = []
     for central in centrals:
-        db_names = {
-            'date': datetime.datetime.now().strftime("%Y-%m-%d"),
-            'status': central + '-statuas.db',
-            'data': central + '-data.db',
-            'log': central + '-log.db'
-        }
-
-        print('初始化数据库:\n状态数据:"{}"\n商家数据:"{}"\n日志数据:"{}"...'.format(
-            db_names['status'], db_names['data'], db_names['log']))
-        with connect_database(db_names['status'], isolation_level='EXCLUSIVE') as conn:
-            _create_status_table(conn, central, depth)
-
-        with connect_database(db_names['data'], isolation_level='EXCLUSIVE') as conn:
+        db_names = _central_db_names(central)
+        print('分配中心{}的数据...'.format(central))
+
+        with connect_database(db_names['status']) as conn:
+            cursor = conn.cursor()
+            _create_status_schema(cursor)
+            _attach(conn, shared_names['status'], 'shared_status')
+            cursor.execute('BEGIN')
+            # 自适应拆分出的子网格按前缀属于父网格的中心
+            for length in lengths:
+                cursor.execute('''
+                    INSERT OR IGNORE INTO grid SELECT g.* FROM shared_status.grid g
+                    JOIN shared_status.grid_owners o ON o.geohash = SUBSTR(g.geohash, 1, ?) AND o.central = ?
+                    WHERE LENGTH(g.geohash) >= ?''', (length, central, length))
+            conn.commit()
+
+        with connect_database(db_names['data']) as conn:
             _create_data_table(conn)
             _create_categery_table(conn)
+            cursor = conn.cursor()
+            _attach(conn, shared_names['data'], 'shared_data')
+            _attach(conn, shared_names['status'], 'shared_status')
+            cursor.execute('BEGIN')
+            cursor.execute('CREATE TEMP TABLE owned(id INTEGER PRIMARY KEY)')
+            for length in lengths:
+                cursor.execute('''
+                    INSERT OR IGNORE INTO owned SELECT c.restaurant_id FROM shared_data.restaurant_cells c
+                    JOIN shared_status.grid_owners o ON o.geohash = SUBSTR(c.geohash, 1, ?) AND o.central = ?
+                    WHERE LENGTH(c.geohash) >= ?''', (length, central, length))
+            cursor.execute('INSERT INTO restaurants SELECT r.* FROM shared_data.restaurants r '
+                           'JOIN owned ON owned.id = r.id')
+            cursor.execute('INSERT INTO restaurant_categories SELECT c.* FROM shared_data.restaurant_categories c '
+                           'JOIN owned ON owned.id = c.restaurant_id')
+            cursor.execute('INSERT INTO menus SELECT m.* FROM shared_data.menus m '
+                           'JOIN owned ON owned.id = m.restaurant_id')
+            cursor.execute('INSERT INTO menu_versions SELECT v.* FROM shared_data.menu_versions v '
+                           'JOIN owned ON owned.id = v.restaurant_id')
+            cursor.execute('DROP TABLE owned')
+            conn.commit()
+
+        with connect_database(db_names['status']) as conn:
+            _attach(conn, shared_names['status'], 'shared_status')
+            _attach(conn, db_names['data'], 'central_data')
+            conn.execute('INSERT INTO restaurants SELECT s.* FROM shared_status.restaurants s '
+                         'JOIN central_data.restaurants r ON r.id = s.id')
 
         with connect_database(db_names['log'], isolation_level='EXCLUSIVE') as conn:
             _create_log_table(conn)
 
+        with connect_database(db_names['log']) as conn:
+            cursor = conn.cursor()
+            _attach(conn, shared_names['log'], 'shared_log')
+            _attach(conn, db_names['status'], 'central_status')
+            _attach(conn, db_names['data'], 'central_data')
+            cursor.execute('BEGIN')
+            # 商家日志按网格, 菜单日志按商家属于中心
+            for table in ('fetch_restaurant_log', 'fetch_restaurant_exception'):
+                cursor.execute('INSERT INTO {0} SELECT * FROM shared_log.{0} '
+                               'WHERE geohash IN (SELECT geohash FROM central_status.grid)'.format(table))
+            for table in ('fetch_menu_log', 'fetch_menu_exception'):
+                cursor.execute('INSERT INTO {0} SELECT * FROM shared_log.{0} '
+                               'WHERE restaurant_id IN (SELECT id FROM central_data.restaurants)'.format(table))
+            conn.commit()
+
         db_name_sequence.append(db_names)
     return db_name_sequence
 
 
 
-def prepare_restaurant_status_table(db_names):
-    with connect_database(db_names['data'], isolation_level='EXCLUSIVE') as data_conn:
-        data_curosr = data_conn.cursor()
-        data_rows = data_curosr.execute('select id from restaurants')
+def prepare_restaurant_status_table(db_names, incremental=False):
+    """
+    把商家数据库中的商家id加入菜单抓取队列, 已在队列中的商家(流水线模式)保持不变
+    :param incremental: 只加入本次抓取中新增或变化的商家, 以及还没有菜单的商家
+    """
+    with connect_database(db_names['status']) as status_conn:
+        _attach(status_conn, db_names['data'], 'data')
+        if not incremental:
+            status_conn.execute('INSERT OR IGNORE INTO restaurants(id) SELECT id FROM data.restaurants')
+            return
+        cursor = status_conn.execute('''
+            INSERT OR IGNORE INTO restaurants(id)
+            SELECT restaurant_id FROM data.restaurant_changes
+                WHERE rowid > (SELECT last_change FROM data.crawl_info) AND change IN ('A','U')
+                AND restaurant_id IN (SELECT id FROM data.restaurants)
+            UNION
+            SELECT id FROM data.restaurants WHERE id NOT IN (SELECT restaurant_id FROM data.menu_versions)''')
+        print('增量抓取: %d个商家需要抓取菜单' % cursor.rowcount)
+
 
-        with connect_database(db_names['status'], isolation_level='EXCLUSIVE') as status_conn:
-            status_cursor = status_conn.cursor()
-            for row in data_rows:
-                status_cursor.execute('''INSERT INTO restaurants(id) VALUES(?);''', row)
-            status_conn.commit()
+def reset_unconfirmed_status(db_names, committed_until):
+    """
+    写入进程异常退出后, 把已领取但没有完成的任务, 以及完成时数据可能还没有提交的任务重置为未抓取
+    :param committed_until: 写入进程提交的数据中最后一批放入队列的时间(time.time())
+    """
+    # commit_date只精确到秒, 多个进程放入队列的顺序也不严格, 多重置几秒内完成的任务
+    since = committed_until - _UNCONFIRMED_MARGIN
+    with connect_database(db_names['status']) as conn:
+        cursor = conn.cursor()
+        cursor.execute('BEGIN')
+        num_reset = 0
+        for table in ('grid', 'restaurants'):
+            cursor.execute('''UPDATE {} SET fetch_status = 0 WHERE fetch_status = 1 OR
+                              (fetch_status != 0 AND commit_date >= datetime(?, 'unixepoch', 'localtime'))'''.format(
+                                   table), (since,))
+            num_reset += cursor.rowcount
+        conn.commit()
+    print('\n写入进程异常退出, %d个网格和商家已重置为未抓取' % num_reset)
 
 
 def connect_database(db_name, isolation_level=None):
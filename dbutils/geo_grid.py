@@ -0,0 +1,228 @@
+import numpy as np
+
+_GEOHASH_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+_BASE32_INDEX = dict((c, i) for i, c in enumerate(_GEOHASH_BASE32))
+_BASE32_CHARS = np.array(list(_GEOHASH_BASE32))
+
+_EARTH_RADIUS = 6371.0088
+# 半径过滤使用球面距离, 放宽1%避免漏掉按椭球距离仍在范围内的网格
+_RADIUS_TOLERANCE = 1.01
+
+
+def geohash_children(cell):
+    """
+    :return: 精度+1的32个子网格
+    """
+    return [cell + c for c in _GEOHASH_BASE32]
+
+
+def _bit_sizes(precision):
+    """
+    :return: (经度位数, 纬度位数), geohash从经度位开始交错
+    """
+    num_bits = precision * 5
+    return (num_bits + 1) // 2, num_bits // 2
+
+
+def decode_cell(cell):
+    """
+    :return: (经度网格序号, 纬度网格序号)
+    """
+    value = 0
+    for c in cell:
+        value = (value << 5) | _BASE32_INDEX[c]
+
+    num_bits = len(cell) * 5
+    lon = lat = 0
+    for bit in range(num_bits - 1, -1, -1):
+        if (num_bits - 1 - bit) % 2 == 0:
+            lon = (lon << 1) | ((value >> bit) & 1)
+        else:
+            lat = (lat << 1) | ((value >> bit) & 1)
+    return lon, lat
+
+
+def encode_cells(lon, lat, precision):
+    """
+    把经纬度网格序号数组交错编码成geohash
+    :param lon: 经度网格序号(int64数组)
+    :param lat: 纬度网格序号(int64数组)
+    :return: geohash字符串数组
+    """
+    lon_bits, lat_bits = _bit_sizes(precision)
+    value = np.zeros(len(lon), dtype=np.int64)
+    for n in range(0, lon_bits):
+        value |= ((lon >> (lon_bits - 1 - n)) & 1) << (precision * 5 - 1 - 2 * n)
+    for n in range(0, lat_bits):
+        value |= ((lat >> (lat_bits - 1 - n)) & 1) << (precision * 5 - 2 - 2 * n)
+
+    shifts = np.arange(precision - 1, -1, -1, dtype=np.int64) * 5
+    codes = (value[:, np.newaxis] >> shifts) & 31
+    return np.ascontiguousarray(_BASE32_CHARS[codes]).view('<U%d' % precision).ravel()
+
+
+def _square_indices(central, depth):
+    """
+    :return: (经度网格序号数组, 纬度网格序号数组), 按与中心的距离排序
+    """
+    lon_bits, lat_bits = _bit_sizes(len(central))
+    lon0, lat0 = decode_cell(central)
+
+    offsets = np.arange(-(depth - 1), depth, dtype=np.int64)
+    dlon, dlat = np.meshgrid(offsets, offsets)
+    dlon = dlon.ravel()
+    dlat = dlat.ravel()
+
+    lat = lat0 + dlat
+    valid = (lat >= 0) & (lat < (1 << lat_bits))
+    lon = (lon0 + dlon[valid]) % (1 << lon_bits)
+    lat = lat[valid]
+
+    order = np.argsort(np.maximum(np.abs(dlon[valid]), np.abs(dlat[valid])), kind='stable')
+    return lon[order], lat[order]
+
+
+def square_grid(central, depth):
+    """
+    以central为中心, 切比雪夫距离小于depth的正方形网格, 与逐层查找邻居得到的网格相同.
+    经度方向跨越180度时回绕, 纬度方向超出范围的网格被丢弃
+    :return: 按与中心的距离排序的geohash数组
+    """
+    lon, lat = _square_indices(central, depth)
+    return encode_cells(lon, lat, len(central))
+
+
+def _cell_size(precision):
+    """
+    :return: (经度宽度, 纬度高度), 单位为度
+    """
+    lon_bits, lat_bits = _bit_sizes(precision)
+    return 360.0 / (1 << lon_bits), 180.0 / (1 << lat_bits)
+
+
+def _cell_bounds(lon, lat, precision):
+    """
+    :return: (最小纬度, 最小经度, 最大纬度, 最大经度)数组
+    """
+    width, height = _cell_size(precision)
+    min_lon = lon * width - 180.0
+    min_lat = lat * height - 90.0
+    return min_lat, min_lon, min_lat + height, min_lon + width
+
+
+def cell_center(cell):
+    """
+    :return: (纬度, 经度)
+    """
+    lon, lat = decode_cell(cell)
+    width, height = _cell_size(len(cell))
+    return (lat + 0.5) * height - 90.0, (lon + 0.5) * width - 180.0
+
+
+def _covering_depth(central, points):
+    """
+    :param points: [(纬度, 经度), ...]
+    :return: 覆盖所有点的正方形网格深度
+    """
+    lon0, lat0 = decode_cell(central)
+    width, height = _cell_size(len(central))
+    depth = 1
+    for lat, lon in points:
+        offset = max(abs(int((lon + 180.0) // width) - lon0), abs(int((lat + 90.0) // height) - lat0))
+        depth = max(depth, offset + 1)
+    return depth
+
+
+def points_in_polygon(lats, lons, polygon):
+    """
+    射线法判断点是否在多边形内(奇偶规则)
+    :param polygon: [[纬度, 经度], ...]
+    """
+    inside = np.zeros(len(lats), dtype=bool)
+    for i in range(0, len(polygon)):
+        lat1, lon1 = polygon[i]
+        lat2, lon2 = polygon[i - 1]
+        if lat1 == lat2:
+            continue
+        crosses = (lat1 > lats) != (lat2 > lats)
+        x = (lon2 - lon1) * (lats - lat1) / (lat2 - lat1) + lon1
+        inside ^= crosses & (lons < x)
+    return inside
+
+
+def _segment_intersects_cells(p1, p2, min_lat, min_lon, max_lat, max_lon):
+    (lat1, lon1), (lat2, lon2) = p1, p2
+    overlap = (min(lon1, lon2) <= max_lon) & (max(lon1, lon2) >= min_lon) & \
+              (min(lat1, lat2) <= max_lat) & (max(lat1, lat2) >= min_lat)
+
+    # 网格的四个角都在线段所在直线的同一侧时不相交
+    sides = [(lon2 - lon1) * (lat - lat1) - (lat2 - lat1) * (lon - lon1)
+             for lat, lon in ((min_lat, min_lon), (min_lat, max_lon), (max_lat, min_lon), (max_lat, max_lon))]
+    same_side = ((sides[0] > 0) & (sides[1] > 0) & (sides[2] > 0) & (sides[3] > 0)) | \
+                ((sides[0] < 0) & (sides[1] < 0) & (sides[2] < 0) & (sides[3] < 0))
+    return overlap & ~same_side
+
+
+def polygon_mask(lon, lat, precision, polygon):
+    """
+    网格与多边形相交: 网格有角在多边形内(包括网格完全在多边形内), 或多边形有边穿过网格(包括顶点在网格内)
+    """
+    min_lat, min_lon, max_lat, max_lon = _cell_bounds(lon, lat, precision)
+    mask = np.zeros(len(lon), dtype=bool)
+    for corner_lat, corner_lon in ((min_lat, min_lon), (min_lat, max_lon), (max_lat, min_lon), (max_lat, max_lon)):
+        mask |= points_in_polygon(corner_lat, corner_lon, polygon)
+    for i in range(0, len(polygon)):
+        mask |= _segment_intersects_cells(polygon[i - 1], polygon[i], min_lat, min_lon, max_lat, max_lon)
+    return mask
+
+
+def radius_mask(lon, lat, precision, center, radius):
+    """
+    网格上离圆心最近的点在半径内时网格与圆相交
+    :param center: (纬度, 经度)
+    :param radius: 半径(公里)
+    """
+    min_lat, min_lon, max_lat, max_lon = _cell_bounds(lon, lat, precision)
+    nearest_lat = np.radians(np.clip(center[0], min_lat, max_lat))
+    nearest_lon = np.radians(np.clip(center[1], min_lon, max_lon))
+    center_lat, center_lon = np.radians(center[0]), np.radians(center[1])
+    a = np.sin((nearest_lat - center_lat) / 2) ** 2 + \
+        np.cos(center_lat) * np.cos(nearest_lat) * np.sin((nearest_lon - center_lon) / 2) ** 2
+    distance = 2 * _EARTH_RADIUS * np.arcsin(np.sqrt(a))
+    return distance <= radius * _RADIUS_TOLERANCE
+
+
+def bounded_grid(central, depth=None, polygon=None, radius=None):
+    """
+    只保留与多边形或圆相交的网格, 范围外的网格不会被抓取
+    :param depth: 正方形网格深度, None时由polygon/radius的范围决定
+    :param polygon: [[纬度, 经度], ...]
+    :param radius: 以central的中心为圆心的半径(公里)
+    :return: 按与中心的距离排序的geohash数组
+    """
+    precision = len(central)
+    center = cell_center(central)
+    if depth is None:
+        points = [center]
+        if polygon is not None:
+            points.extend(polygon)
+        if radius is not None:
+            dlat = np.degrees(radius * _RADIUS_TOLERANCE / _EARTH_RADIUS)
+            dlon = dlat / np.cos(np.radians(center[0]))
+            points.extend([(center[0] - dlat, center[1] - dlon), (center[0] + dlat, center[1] + dlon)])
+        depth = _covering_depth(central, points)
+
+    lon, lat = _square_indices(central, depth)
+    mask = np.ones(len(lon), dtype=bool)
+    if polygon is not None:
+        mask &= polygon_mask(lon, lat, precision, polygon)
+    if radius is not None:
+        mask &= radius_mask(lon, lat, precision, center, radius)
+    return encode_cells(lon[mask], lat[mask], precision)
+
+
+def coarse_grid(cells, precision):
+    """
+    :return: 覆盖cells的precision位geohash, 已排序去重
+    """
+    return np.unique(cells.astype('<U%d' % precision))
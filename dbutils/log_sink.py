@@ -0,0 +1,92 @@
+import hashlib
+import threading
+import time
+
+from dbutils import db_utils
+
+_DEFAULT_MAX_ENTRIES = 256
+_DEFAULT_FLUSH_INTERVAL = 5.0
+_DEFAULT_MAX_MESSAGE_SIZE = 512
+
+# 日志表: (主键列名, 是否有HTTP状态码)
+_LOG_TABLES = {
+    'fetch_restaurant_log': ('geohash', True),
+    'fetch_restaurant_exception': ('geohash', False),
+    'fetch_menu_log': ('restaurant_id', True),
+    'fetch_menu_exception': ('restaurant_id', False),
+}
+
+
+def _message_hash(message):
+    return hashlib.md5(message.encode('utf-8', errors='replace')).hexdigest()[:16]
+
+
+class LogSink(object):
+    """
+    缓冲写入日志数据库. 相同的(主键, 状态码, 消息hash)只保留一行并累加count.
+    记录日志时不访问数据库, 抓取器每完成一个网格或商家调用一次flush_if_due,
+    缓冲达到max_entries条或距上次写入超过flush_interval秒时批量写入, 结束时需要调用flush
+    """
+
+    def __init__(self, db_name, max_entries=_DEFAULT_MAX_ENTRIES, flush_interval=_DEFAULT_FLUSH_INTERVAL,
+                 max_message_size=_DEFAULT_MAX_MESSAGE_SIZE):
+        self.db_name = db_name
+        self.max_entries = max_entries
+        self.flush_interval = flush_interval
+        self.max_message_size = max_message_size
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._last_flush = time.monotonic()
+
+    def _add(self, table, key, http_code, message):
+        message = message if message is not None else ''
+        entry_key = (table, key, http_code, _message_hash(message))
+        with self._lock:
+            entry = self._entries.get(entry_key)
+            if entry is None:
+                self._entries[entry_key] = [message[:self.max_message_size], 1]
+            else:
+                entry[1] += 1
+
+    def log_http_error(self, table, key, http_code, message):
+        self._add(table, key, http_code, message)
+
+    def log_exception(self, table, key, message):
+        self._add(table, key, None, message)
+
+    def flush_if_due(self):
+        with self._lock:
+            should_flush = len(self._entries) >= self.max_entries or (
+                len(self._entries) != 0 and time.monotonic() - self._last_flush >= self.flush_interval)
+        if should_flush:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            entries = self._entries
+            self._entries = {}
+            self._last_flush = time.monotonic()
+        if len(entries) == 0:
+            return
+
+        rows = {}
+        for (table, key, http_code, message_hash), (message, count) in entries.items():
+            if _LOG_TABLES[table][1]:
+                rows.setdefault(table, []).append((key, http_code, message, message_hash, count))
+            else:
+                rows.setdefault(table, []).append((key, message, message_hash, count))
+
+        with db_utils.connect_database(self.db_name) as conn:
+            for table, table_rows in rows.items():
+                key_column, has_http_code = _LOG_TABLES[table]
+                if has_http_code:
+                    conn.executemany('''
+                        INSERT INTO {0}({1},http_status_code,error_message,message_hash,count) VALUES(?,?,?,?,?)
+                        ON CONFLICT({1},http_status_code,message_hash) DO UPDATE SET count = count + excluded.count
+                        '''.format(table, key_column), table_rows)
+                else:
+                    conn.executemany('''
+                        INSERT INTO {0}({1},exception,message_hash,count) VALUES(?,?,?,?)
+                        ON CONFLICT({1},message_hash) DO UPDATE SET count = count + excluded.count
+                        '''.format(table, key_column), table_rows)
+            conn.commit()
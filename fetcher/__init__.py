@@ -1,3 +1 @@
-__all__ = ['worker', 'url_utils']
-
-
+__all__ = ['worker', 'aio_worker', 'parsers', 'retry', 'transport', 'url_utils']
@@ -0,0 +1,228 @@
+import asyncio
+import os
+from http import HTTPStatus
+
+from dbutils.data_writer import DataWriterProcess
+from dbutils.log_sink import LogSink
+from fetcher import url_utils
+from fetcher.retry import CircuitBreaker
+from fetcher.transport import AioTransport
+from fetcher.worker import FETCH_STATUS_FAILED, RESTAURANT_CATEGORIES, MenuFetcher, PipelineFetcher, \
+    RestaurantFetcher, _REQUEST_TIMEOUT, stop_data_writer
+
+_DEFAULT_CONCURRENCY = 200
+
+
+async def _run_blocking(func, *args):
+    """
+    在线程池中执行会访问sqlite的同步调用(领取任务的排他事务最多等待busy timeout), 不阻塞事件循环
+    """
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+
+async def _wait_circuit_breaker(circuit_breaker):
+    delay = circuit_breaker.wait_time()
+    while delay > 0:
+        await asyncio.sleep(delay)
+        delay = circuit_breaker.wait_time()
+
+
+class AsyncRestaurantFetcher(RestaurantFetcher):
+    """
+    协程版的商家抓取器, 数据库的读写与RestaurantFetcher完全一致,
+    一个网格的35个分类请求会同时发出, 由共享的semaphore限制总并发数
+    """
+
+    def __init__(self, db_names, transport, semaphore, **options):
+        super().__init__(db_names, transport, **options)
+        self._semaphore = semaphore
+
+    async def _fetch_page(self, geohash, minor_cat, offset):
+        for attempt in range(0, self.retry_policy.max_attempts):
+            await _wait_circuit_breaker(self.circuit_breaker)
+            try:
+                async with self._semaphore:
+                    r = await self.transport.get(
+                            url_utils.create_fetch_restaurant_url(geohash, minor_cat, offset, self.page_size),
+                            timeout=_REQUEST_TIMEOUT)
+                if r.status_code == HTTPStatus.OK:
+                    self.circuit_breaker.record_success()
+                    return self._store_restaurants(geohash, minor_cat, r.content)
+                else:
+                    self.circuit_breaker.record_failure()
+                    self._log_http_error(geohash, r.status_code, r.text)
+            except Exception as e:
+                self.circuit_breaker.record_failure()
+                self._log_exception(geohash, str(e))
+            if attempt < self.retry_policy.max_attempts - 1:
+                await asyncio.sleep(self.retry_policy.delay(attempt))
+        return None
+
+    async def _fetch_cell_category(self, geohash, minor_cat):
+        count = 0
+        while True:
+            page_count = await self._fetch_page(geohash, minor_cat, count)
+            if page_count is None:
+                return None
+            count += page_count
+            if not self._has_next_page(geohash, minor_cat, page_count, count):
+                return count
+
+    async def _fetch_cell(self, geohash, categories=None):
+        minors = self._cell_categories(categories)
+        results = await asyncio.gather(*[self._fetch_cell_category(geohash, minor) for minor in minors])
+        await _run_blocking(self._complete_cell, geohash, dict(zip(minors, results)))
+
+    async def run(self):
+        geohash = await _run_blocking(self._take_geohash)
+        while geohash is not None:
+            await self._fetch_cell(geohash[0], geohash[1])
+            geohash = await _run_blocking(self._take_geohash)
+        await _run_blocking(self.log_sink.flush)
+
+
+class AsyncMenuFetcher(MenuFetcher):
+    """
+    协程版的菜单抓取器, 数据库的读写与MenuFetcher完全一致
+    """
+
+    def __init__(self, db_names, transport, semaphore, **options):
+        super().__init__(db_names, transport, **options)
+        self._semaphore = semaphore
+
+    async def _fetch_restaurant(self, restaurant_id):
+        for attempt in range(0, self.retry_policy.max_attempts):
+            await _wait_circuit_breaker(self.circuit_breaker)
+            try:
+                async with self._semaphore:
+                    r = await self.transport.get(url_utils.create_fetch_menu_url(restaurant_id),
+                                                 timeout=_REQUEST_TIMEOUT,
+                                                 headers=self._conditional_headers(restaurant_id))
+                if await _run_blocking(self._handle_response, restaurant_id, r):
+                    return
+            except Exception as e:
+                self.circuit_breaker.record_failure()
+                self._log_exception(restaurant_id, str(e))
+            if attempt < self.retry_policy.max_attempts - 1:
+                await asyncio.sleep(self.retry_policy.delay(attempt))
+        await _run_blocking(self._finish_restaurant, restaurant_id, FETCH_STATUS_FAILED)
+
+    async def run(self):
+        restaurant_id = await _run_blocking(self._take_restaurant)
+        while restaurant_id is not None:
+            await self._fetch_restaurant(restaurant_id[0])
+            await _run_blocking(self._write_cache_to_database)
+            restaurant_id = await _run_blocking(self._take_restaurant)
+        await _run_blocking(self.log_sink.flush)
+
+
+class AsyncPipelineFetcher(PipelineFetcher):
+    """
+    协程版的流水线抓取器, 网格和菜单的请求共用同一个semaphore
+    """
+
+    def __init__(self, db_names, transport, semaphore, **options):
+        self._semaphore = semaphore
+        super().__init__(db_names, transport, **options)
+
+    def _create_restaurant_fetcher(self, transport, options):
+        return AsyncRestaurantFetcher(self.db_names, transport, self._semaphore, **options)
+
+    def _create_menu_fetcher(self, transport, options):
+        return AsyncMenuFetcher(self.db_names, transport, self._semaphore, **options)
+
+    async def _fetch_menu(self):
+        restaurant_id = await _run_blocking(self.menu_fetcher._take_restaurant)
+        if restaurant_id is None:
+            return False
+        await self.menu_fetcher._fetch_restaurant(restaurant_id[0])
+        await _run_blocking(self.menu_fetcher._write_cache_to_database)
+        return True
+
+    async def _fetch_cell(self):
+        geohash = await _run_blocking(self.restaurant_fetcher._take_geohash)
+        if geohash is None:
+            return False
+        await self.restaurant_fetcher._fetch_cell(geohash[0], geohash[1])
+        return True
+
+    async def _step(self):
+        if self.prefer_menus:
+            return await self._fetch_menu() or await self._fetch_cell()
+        return await self._fetch_cell() or await self._fetch_menu()
+
+    async def run(self):
+        while True:
+            if await self._step():
+                continue
+            if await _run_blocking(self._grid_finished):
+                if not await self._fetch_menu():
+                    break
+            else:
+                await asyncio.sleep(self.poll_interval)
+        await _run_blocking(self.log_sink.flush)
+
+
+class AsyncLauncher(object):
+    """
+    在单个事件循环中运行多个抓取协程, concurrency限制同时在途的请求数
+    """
+
+    def __init__(self, db_names, fetcher_class, concurrency=_DEFAULT_CONCURRENCY, num_workers=None,
+                 transport=None, **options):
+        self.db_names = db_names
+        self.options = options
+        self.options.setdefault('circuit_breaker', CircuitBreaker())
+        self.options.setdefault('log_sink', LogSink(db_names['log']))
+        self.fetcher_class = fetcher_class
+        self.concurrency = concurrency
+        self.num_workers = num_workers if num_workers is not None else concurrency
+        self.transport = transport if transport is not None else AioTransport(concurrency,
+                                                                              timeout=_REQUEST_TIMEOUT)
+
+    def _create_fetchers(self, semaphore):
+        # 抓取器创建时会查询状态数据库
+        return [self.fetcher_class(self.db_names, self.transport, semaphore, **self.options)
+                for n in range(0, self.num_workers)]
+
+    async def _run(self):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        await self.transport.open()
+        try:
+            fetchers = await _run_blocking(self._create_fetchers, semaphore)
+            await asyncio.gather(*[fetcher.run() for fetcher in fetchers])
+        finally:
+            await self.transport.close()
+
+    def run(self):
+        print('进程%d已启动(协程并发数:%d)' % (os.getpid(), self.concurrency))
+        # 数据库写入放在单独的进程中, 事件循环不会因提交事务而阻塞
+        data_writer = None
+        if 'data_writer' not in self.options:
+            data_writer = DataWriterProcess(self.db_names['data'])
+            data_writer.start()
+            self.options['data_writer'] = data_writer.client()
+
+        try:
+            asyncio.run(self._run())
+        finally:
+            if data_writer is not None:
+                del self.options['data_writer']
+                stop_data_writer(data_writer, self.db_names)
+        print('\n进程%d %s' % (os.getpid(), self.transport.stats.summary()))
+        print('进程%d已结束' % os.getpid())
+
+
+def create_restaurant_launcher(db_names, concurrency=_DEFAULT_CONCURRENCY, **options):
+    # 每个网格会同时发出35个请求, 不需要与并发数相同的协程数量
+    num_categories = sum(len(minors) for minors in RESTAURANT_CATEGORIES.values())
+    num_workers = max(1, concurrency // num_categories) + 1
+    return AsyncLauncher(db_names, AsyncRestaurantFetcher, concurrency, num_workers, **options)
+
+
+def create_menu_launcher(db_names, concurrency=_DEFAULT_CONCURRENCY, **options):
+    return AsyncLauncher(db_names, AsyncMenuFetcher, concurrency, **options)
+
+
+def create_pipeline_launcher(db_names, concurrency=_DEFAULT_CONCURRENCY, **options):
+    return AsyncLauncher(db_names, AsyncPipelineFetcher, concurrency, **options)
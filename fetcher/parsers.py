@@ -0,0 +1,110 @@
+import json
+import operator
+import time
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# 与restaurants表的列顺序一致
+_RESTAURANT_FIELDS = ('id', 'name', 'name_for_url', 'rating', 'rating_count', 'month_sales', 'phone', 'latitude',
+                      'longitude', 'is_free_delivery', 'delivery_fee', 'minimum_order_amount',
+                      'minimum_free_delivery_amount', 'promotion_info', 'address')
+
+# 与menus表插入语句的列顺序一致, price由specfoods计算
+_FOOD_FIELDS = ('restaurant_id', 'name', 'pinyin_name', 'rating', 'rating_count', 'month_sales', 'description',
+                'category_id')
+
+
+def _loads(content):
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+class JsonParser(object):
+    """
+    原有的解析方式: 把响应解码成str后完整解析成dict, 再取出需要的字段
+    """
+
+    @staticmethod
+    def _sum_price(specfoods_json):
+        price = 0
+        for f_json in specfoods_json:
+            price += float(f_json['price'])
+
+        count = len(specfoods_json)
+        if count != 0:
+            price /= count
+
+        return price
+
+    def parse_restaurants(self, content):
+        restaurants_json = json.loads(content.decode('utf-8'))
+        return [tuple(r_json[field] for field in _RESTAURANT_FIELDS) for r_json in restaurants_json]
+
+    def parse_menus(self, content):
+        rows = []
+        menus_json = json.loads(content.decode('utf-8'))
+        for menu_category_json in menus_json:  # 分类
+            for food_json in menu_category_json['foods']:
+                rows.append((
+                    food_json['restaurant_id'],
+                    food_json['name'],
+                    food_json['pinyin_name'],
+                    food_json['rating'],
+                    food_json['rating_count'],
+                    self._sum_price(food_json['specfoods']),
+                    food_json['month_sales'],
+                    food_json['description'],
+                    food_json['category_id'],
+                ))
+        return rows
+
+
+class ProjectingParser(object):
+    """
+    直接从响应的bytes解析(有orjson时使用orjson), 用itemgetter只取出需要的列,
+    解析菜品时同时计算规格的平均价格
+    """
+
+    _get_restaurant = staticmethod(operator.itemgetter(*_RESTAURANT_FIELDS))
+    _get_food = staticmethod(operator.itemgetter(*_FOOD_FIELDS))
+
+    def parse_restaurants(self, content):
+        get_restaurant = self._get_restaurant
+        return [get_restaurant(r_json) for r_json in _loads(content)]
+
+    def parse_menus(self, content):
+        rows = []
+        get_food = self._get_food
+        for menu_category_json in _loads(content):
+            for food_json in menu_category_json['foods']:
+                restaurant_id, name, pinyin_name, rating, rating_count, month_sales, description, category_id = \
+                    get_food(food_json)
+                specfoods = food_json['specfoods']
+                price = sum([float(f_json['price']) for f_json in specfoods]) / len(specfoods) \
+                    if len(specfoods) != 0 else 0
+                rows.append((restaurant_id, name, pinyin_name, rating, rating_count, price, month_sales, description,
+                             category_id))
+        return rows
+
+
+PARSERS = {
+    'json': JsonParser,
+    'projecting': ProjectingParser,
+}
+
+
+def cpu_time_per_response(parser, contents, kind='menus'):
+    """
+    :param contents: 响应的bytes列表
+    :param kind: 'restaurants' 或 'menus'
+    :return: 每个响应的平均CPU时间(秒)
+    """
+    parse = parser.parse_menus if kind == 'menus' else parser.parse_restaurants
+    start = time.process_time()
+    for content in contents:
+        parse(content)
+    return (time.process_time() - start) / len(contents) if len(contents) != 0 else 0
@@ -0,0 +1,99 @@
+import collections
+import multiprocessing
+import random
+import sys
+import threading
+import time
+
+_DEFAULT_MAX_ATTEMPTS = 8
+_DEFAULT_BASE_DELAY = 0.5
+_DEFAULT_MAX_DELAY = 30.0
+
+_DEFAULT_WINDOW = 10.0
+_DEFAULT_MIN_REQUESTS = 20
+_DEFAULT_ERROR_RATE = 0.5
+_DEFAULT_COOLDOWN = 30.0
+
+
+class RetryPolicy(object):
+    """
+    带上限的指数退避, 使用full jitter避免所有线程同时重试
+    """
+
+    def __init__(self, max_attempts=_DEFAULT_MAX_ATTEMPTS, base_delay=_DEFAULT_BASE_DELAY,
+                 max_delay=_DEFAULT_MAX_DELAY):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt):
+        """
+        :param attempt: 已失败的次数(从0开始)
+        :return: 下一次重试前等待的秒数
+        """
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+
+class CircuitBreaker(object):
+    """
+    统计最近window秒内的请求错误率, 超过error_rate时熔断cooldown秒, 期间所有抓取器暂停请求.
+    熔断截止时间保存在共享内存中, 通过进程参数传递后同一次任务的所有进程会一起暂停
+    """
+
+    def __init__(self, window=_DEFAULT_WINDOW, min_requests=_DEFAULT_MIN_REQUESTS,
+                 error_rate=_DEFAULT_ERROR_RATE, cooldown=_DEFAULT_COOLDOWN):
+        self.window = window
+        self.min_requests = min_requests
+        self.error_rate = error_rate
+        self.cooldown = cooldown
+        self._open_until = multiprocessing.Value('d', 0.0)
+        self._lock = threading.Lock()
+        self._results = collections.deque()
+        self._num_failures = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        state['_results'] = collections.deque()
+        state['_num_failures'] = 0
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _record(self, failed):
+        now = time.time()
+        with self._lock:
+            self._results.append((now, failed))
+            self._num_failures += failed
+            while len(self._results) != 0 and self._results[0][0] < now - self.window:
+                self._num_failures -= self._results.popleft()[1]
+
+            num_results = len(self._results)
+            if num_results < self.min_requests or self._num_failures / num_results < self.error_rate:
+                return
+
+            self._results.clear()
+            self._num_failures = 0
+
+        with self._open_until.get_lock():
+            if self._open_until.value < now:
+                self._open_until.value = now + self.cooldown
+                sys.stdout.write('\n请求错误率过高, 暂停%d秒\n' % self.cooldown)
+                sys.stdout.flush()
+
+    def record_success(self):
+        self._record(0)
+
+    def record_failure(self):
+        self._record(1)
+
+    def wait_time(self):
+        return max(0.0, self._open_until.value - time.time())
+
+    def wait(self):
+        delay = self.wait_time()
+        while delay > 0:
+            time.sleep(delay)
+            delay = self.wait_time()
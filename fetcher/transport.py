@@ -0,0 +1,285 @@
+import gzip
+import http.client
+import socket
+import ssl
+import threading
+import time
+import zlib
+from urllib.parse import urlsplit
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+_DEFAULT_MAX_PER_HOST = 8
+_DEFAULT_DNS_TTL = 300
+
+_DEFAULT_HEADERS = {
+    'Accept-Encoding': 'gzip, deflate',
+    'Connection': 'keep-alive',
+}
+
+
+class Response(object):
+    """
+    传输层返回的结果, 字段与requests.Response中用到的部分保持一致
+    """
+
+    def __init__(self, status_code, content, headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers if headers is not None else {}
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+    def header(self, name):
+        """
+        不区分大小写地读取响应头, 不存在时返回None
+        """
+        name = name.lower()
+        for key, value in self.headers.items():
+            if key.lower() == name:
+                return value
+        return None
+
+
+class TransportStats(object):
+    """
+    分别统计DNS解析和TCP连接的耗时
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.num_requests = 0
+        self.num_dns = 0
+        self.dns_time = 0.0
+        self.num_connects = 0
+        self.connect_time = 0.0
+
+    def add_request(self):
+        with self._lock:
+            self.num_requests += 1
+
+    def add_dns(self, elapsed):
+        with self._lock:
+            self.num_dns += 1
+            self.dns_time += elapsed
+
+    def add_connect(self, elapsed):
+        with self._lock:
+            self.num_connects += 1
+            self.connect_time += elapsed
+
+    def summary(self):
+        return '请求数:%d DNS:%d次 %.2fs 连接:%d次 %.2fs' % (self.num_requests,
+                                                         self.num_dns, self.dns_time,
+                                                         self.num_connects, self.connect_time)
+
+
+def _decode_body(content, encoding):
+    if encoding == 'gzip':
+        return gzip.decompress(content)
+    elif encoding == 'deflate':
+        try:
+            return zlib.decompress(content)
+        except zlib.error:
+            return zlib.decompress(content, -zlib.MAX_WBITS)
+    return content
+
+
+class _TimedHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, host, port, address, timeout, stats):
+        super().__init__(host, port, timeout=timeout)
+        self._address = address
+        self._stats = stats
+
+    def connect(self):
+        start = time.monotonic()
+        self.sock = socket.create_connection(self._address, self.timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._stats.add_connect(time.monotonic() - start)
+
+
+class _TimedHTTPSConnection(_TimedHTTPConnection):
+    default_port = http.client.HTTPS_PORT
+
+    def __init__(self, host, port, address, timeout, stats):
+        super().__init__(host, port, address, timeout, stats)
+        self._context = ssl.create_default_context()
+
+    def connect(self):
+        super().connect()
+        self.sock = self._context.wrap_socket(self.sock, server_hostname=self.host)
+
+
+class PooledTransport(object):
+    """
+    基于http.client的keep-alive连接池, 每个host最多max_per_host个连接,
+    DNS结果在dns_ttl秒内复用. 可以被多个线程共享
+    """
+
+    def __init__(self, max_per_host=_DEFAULT_MAX_PER_HOST, dns_ttl=_DEFAULT_DNS_TTL):
+        self.max_per_host = max_per_host
+        self.dns_ttl = dns_ttl
+        self.stats = TransportStats()
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._slots = {}
+        self._dns_cache = {}
+
+    def _resolve(self, host, port):
+        now = time.monotonic()
+        with self._lock:
+            cached = self._dns_cache.get((host, port))
+        if cached is not None and cached[0] > now:
+            return cached[1]
+
+        start = time.monotonic()
+        info = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        self.stats.add_dns(time.monotonic() - start)
+        address = info[0][4][:2]
+        with self._lock:
+            self._dns_cache[(host, port)] = (now + self.dns_ttl, address)
+        return address
+
+    def _slot(self, key):
+        with self._lock:
+            slot = self._slots.get(key)
+            if slot is None:
+                slot = threading.BoundedSemaphore(self.max_per_host)
+                self._slots[key] = slot
+            return slot
+
+    def _take_connection(self, key, timeout):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            conn = idle.pop() if len(idle) != 0 else None
+        if conn is not None:
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            conn.timeout = timeout
+            return conn, True
+        return self._new_connection(key, timeout), False
+
+    def _new_connection(self, key, timeout):
+        scheme, host, port = key
+        address = self._resolve(host, port)
+        connection_class = _TimedHTTPSConnection if scheme == 'https' else _TimedHTTPConnection
+        return connection_class(host, port, address, timeout, self.stats)
+
+    def _release_connection(self, key, conn):
+        with self._lock:
+            self._idle.setdefault(key, []).append(conn)
+
+    def get(self, url, timeout=None, headers=None):
+        parts = urlsplit(url)
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        key = (parts.scheme, parts.hostname, port)
+        path = parts.path + ('?' + parts.query if parts.query else '')
+
+        request_headers = dict(_DEFAULT_HEADERS)
+        if headers is not None:
+            request_headers.update(headers)
+
+        self.stats.add_request()
+        with self._slot(key):
+            conn, reused = self._take_connection(key, timeout)
+            try:
+                conn.request('GET', path, headers=request_headers)
+                r = conn.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                conn.close()
+                if not reused:
+                    raise
+                # 空闲的keep-alive连接可能已被服务器关闭, 换一个新连接重试一次
+                conn = self._new_connection(key, timeout)
+                try:
+                    conn.request('GET', path, headers=request_headers)
+                    r = conn.getresponse()
+                except Exception:
+                    conn.close()
+                    raise
+            except Exception:
+                conn.close()
+                raise
+
+            try:
+                content = _decode_body(r.read(), r.getheader('Content-Encoding'))
+            except Exception:
+                conn.close()
+                raise
+
+            if r.will_close:
+                conn.close()
+            else:
+                self._release_connection(key, conn)
+            return Response(r.status, content, dict(r.getheaders()))
+
+    def close(self):
+        with self._lock:
+            idle = self._idle
+            self._idle = {}
+        for connections in idle.values():
+            for conn in connections:
+                conn.close()
+
+
+class AioTransport(object):
+    """
+    基于aiohttp的keep-alive连接池, 供协程抓取器使用, 接口与PooledTransport一致但get为协程
+    """
+
+    def __init__(self, limit, max_per_host=0, dns_ttl=_DEFAULT_DNS_TTL, timeout=None):
+        self.limit = limit
+        self.max_per_host = max_per_host
+        self.dns_ttl = dns_ttl
+        self.timeout = timeout
+        self.stats = TransportStats()
+        self._session = None
+
+    def _create_trace_config(self):
+        trace_config = aiohttp.TraceConfig()
+        stats = self.stats
+
+        async def on_dns_start(session, ctx, params):
+            ctx.dns_start = time.monotonic()
+
+        async def on_dns_end(session, ctx, params):
+            stats.add_dns(time.monotonic() - ctx.dns_start)
+
+        async def on_connect_start(session, ctx, params):
+            ctx.connect_start = time.monotonic()
+
+        async def on_connect_end(session, ctx, params):
+            stats.add_connect(time.monotonic() - ctx.connect_start)
+
+        trace_config.on_dns_resolvehost_start.append(on_dns_start)
+        trace_config.on_dns_resolvehost_end.append(on_dns_end)
+        trace_config.on_connection_create_start.append(on_connect_start)
+        trace_config.on_connection_create_end.append(on_connect_end)
+        return trace_config
+
+    async def open(self):
+        if aiohttp is None:
+            raise RuntimeError('AioTransport requires aiohttp')
+        connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.max_per_host,
+                                         ttl_dns_cache=self.dns_ttl)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        self._session = aiohttp.ClientSession(connector=connector, timeout=timeout,
+                                              headers=_DEFAULT_HEADERS,
+                                              trace_configs=[self._create_trace_config()])
+
+    async def get(self, url, timeout=None, headers=None):
+        self.stats.add_request()
+        request_timeout = aiohttp.ClientTimeout(total=timeout) if timeout is not None else None
+        async with self._session.get(url, timeout=request_timeout, headers=headers) as r:
+            content = await r.read()
+            return Response(r.status, content, dict(r.headers))
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
@@ -28,8 +28,6 @@ _FETCH_RESTAURANTS_PREDEFINED_ITEMS = [
     {'key': 'extras%5B%5D', 'value': 'food_activity'},
     {'key': 'extras%5B%5D', 'value': 'restaurant_activity'},
     {'key': 'extras%5B%5D', 'value': 'certification'},
-    {'key': 'offset', 'value': '0'},
-    {'key': 'limit', 'value': '1000'},
     {'key': 'type', 'value': 'geohash'},
 ]
 
@@ -44,13 +42,16 @@ def _format_predefined_items():
 _HOST = 'http://www.ele.me/restapi/v4/restaurants?'
 
 _FETCH_RESTAURANTS_URL = _HOST + _format_url_fields() + _format_predefined_items() + \
-                         'geohash={}&restaurant_category_id={}'
+                         'offset={}&limit={}&geohash={}&restaurant_category_id={}'
+
+# 接口单次请求允许的最大数量
+MAX_PAGE_SIZE = 1000
 
 _FETCH_MENU_URL = 'http://www.ele.me/restapi/v4/restaurants/{}/mutimenu'
 
 
-def create_fetch_restaurant_url(geohash, category_id):
-    return _FETCH_RESTAURANTS_URL.format(geohash, category_id)
+def create_fetch_restaurant_url(geohash, category_id, offset=0, limit=MAX_PAGE_SIZE):
+    return _FETCH_RESTAURANTS_URL.format(offset, limit, geohash, category_id)
 
 
 def create_fetch_menu_url(restaurant_id):
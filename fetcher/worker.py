@@ -1,16 +1,51 @@
-import json
+import collections
+import hashlib
+import itertools
 import multiprocessing
 import os
 import sys
 import threading
+import time
+from http import HTTPStatus
 
-import requests
-
-from dbutils import db_utils
+from dbutils import db_utils, geo_grid
+from dbutils.data_writer import DataWriterError, DataWriterProcess, DirectWriter
+from dbutils.log_sink import LogSink
 from fetcher import url_utils
+from fetcher.parsers import ProjectingParser
+from fetcher.retry import CircuitBreaker, RetryPolicy
+from fetcher.transport import PooledTransport
 
 _REQUEST_TIMEOUT = 3
 
+# fetch_status: 0 未抓取, 1 抓取中, 2 完成, 3 超过重试次数, 其他值为HTTP状态码(如404)
+FETCH_STATUS_FAILED = 3
+
+# 每次从状态数据库领取的任务数量
+_DEFAULT_LEASE_SIZE = 8
+
+# 自适应网格: 某个分类的结果数达到阈值时, 把网格拆分成32个子网格重新抓取该分类
+_DEFAULT_SPLIT_THRESHOLD = 900
+
+# 商家列表每页的数量
+_DEFAULT_PAGE_SIZE = 200
+
+# 单个网格单个分类最多翻到的偏移量, 忽略offset的服务器会一直返回满页
+_DEFAULT_MAX_OFFSET = 5000
+
+# 流水线模式下, 暂时没有任务但网格还没有抓取完成时的等待时间(秒)
+_DEFAULT_POLL_INTERVAL = 1.0
+
+# 流水线模式下传给MenuFetcher的参数, 其余参数只属于RestaurantFetcher
+_MENU_OPTIONS = ('lease_size', 'retry_policy', 'circuit_breaker', 'log_sink', 'data_writer', 'parser')
+
+# 领取网格的顺序: grid 按网格创建顺序, oldest 最久没有抓取的优先, random 随机
+_REFRESH_ORDERS = {
+    'grid': '',
+    'oldest': 'ORDER BY commit_date IS NOT NULL, commit_date',
+    'random': 'ORDER BY RANDOM()',
+}
+
 # 207 全部快餐类
 # 220 全部正餐类
 # 233 小吃零食
@@ -26,52 +61,92 @@ RESTAURANT_CATEGORIES = {
 
 
 class RestaurantFetcher(object):
-    def __init__(self, db_names):
+    def __init__(self, db_names, transport=None, lease_size=_DEFAULT_LEASE_SIZE, retry_policy=None,
+                 circuit_breaker=None, log_sink=None, data_writer=None, max_precision=None,
+                 split_threshold=_DEFAULT_SPLIT_THRESHOLD, page_size=_DEFAULT_PAGE_SIZE, parser=None,
+                 incremental=False, refresh_order='grid', record_cells=False, enqueue_menus=False,
+                 max_offset=_DEFAULT_MAX_OFFSET):
+        """
+        :param max_precision: 自适应网格拆分的最大geohash精度, None为不拆分
+        :param split_threshold: 单个分类结果数达到该值时拆分网格
+        :param page_size: 商家列表每页的数量
+        :param max_offset: 单个分类翻页的上限, 达到时停止翻页并记录到日志
+        :param incremental: 只更新字段有变化的商家, 并记录本次抓取到的商家id
+        :param refresh_order: 领取网格的顺序, 见_REFRESH_ORDERS
+        :param record_cells: 记录商家是在哪个网格中抓取到的(多中心共享抓取, 增量抓取时总是记录)
+        :param enqueue_menus: 网格完成时把商家id加入状态数据库的restaurants表, 菜单抓取不需要等待商家抓取结束
+        """
         self.db_names = db_names
+        self.transport = transport if transport is not None else PooledTransport()
+        self.lease_size = lease_size
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self.circuit_breaker = circuit_breaker if circuit_breaker is not None else CircuitBreaker()
+        self.log_sink = log_sink if log_sink is not None else LogSink(db_names['log'])
+        self.data_writer = data_writer if data_writer is not None else DirectWriter(db_names['data'])
+        self.parser = parser if parser is not None else ProjectingParser()
+        self.max_precision = max_precision
+        self.split_threshold = split_threshold
+        if page_size < 1:
+            raise ValueError('page_size必须大于0')
+        self.page_size = min(page_size, url_utils.MAX_PAGE_SIZE)
+        self.max_offset = max_offset
+        self.incremental = incremental
+        self._lease_order = _REFRESH_ORDERS[refresh_order]
+        self.record_cells = record_cells or incremental
+        self.enqueue_menus = enqueue_menus
+        self._leased = collections.deque()
         self.num_cells = self._num_cells()
         self.num_finished = 0
         self.num_restaurants = 0
         self._restaurant_cache = []
         self._category_cache = []
+        self._cell_cache = []
 
     def _log_http_error(self, geohash, http_code, error_msg):
-        with db_utils.connect_database(self.db_names['log']) as conn:
-            conn.execute('INSERT INTO fetch_restaurant_log VALUES(?,?,?)',
-                         (geohash, http_code, error_msg))
-            conn.commit()
+        self.log_sink.log_http_error('fetch_restaurant_log', geohash, http_code, error_msg)
 
     def _log_exception(self, geohash, exception):
-        with db_utils.connect_database(self.db_names['log']) as conn:
-            conn.execute('INSERT INTO fetch_restaurant_exception VALUES(?,?)',
-                         (geohash, exception))
-            conn.commit()
+        self.log_sink.log_exception('fetch_restaurant_exception', geohash, exception)
 
-    def _take_geohash(self):
+    def _lease_geohashes(self):
         with db_utils.connect_database(self.db_names['status'], isolation_level='EXCLUSIVE') as conn:
             cursor = conn.cursor()
             cursor.execute('BEGIN EXCLUSIVE')
-            geohash = cursor.execute('SELECT geohash FROM grid WHERE fetch_status = 0 LIMIT 1').fetchone()
-            if geohash is not None:
-                cursor.execute('UPDATE grid SET fetch_status = 1 WHERE geohash = ?', geohash)
+            rows = cursor.execute('SELECT geohash,categories FROM grid WHERE fetch_status = 0 {} LIMIT ?'.format(
+                                  self._lease_order), (self.lease_size,)).fetchall()
+            cursor.executemany('UPDATE grid SET fetch_status = 1 WHERE geohash = ?', [row[:1] for row in rows])
             conn.commit()
-            return geohash
+            self._leased.extend(rows)
 
-    def _finish_geohash(self, geohash):
+    def _take_geohash(self):
+        if len(self._leased) == 0:
+            self._lease_geohashes()
+        return self._leased.popleft() if len(self._leased) != 0 else None
+
+    def _finish_geohash(self, geohash, status_code=2, restaurant_ids=()):
+        """
+        :param restaurant_ids: 与网格状态在同一个事务中加入菜单抓取队列的商家id
+        """
         with db_utils.connect_database(self.db_names['status']) as conn:
             cursor = conn.cursor()
+            cursor.execute('BEGIN')
+            cursor.executemany('INSERT OR IGNORE INTO restaurants(id) VALUES(?)',
+                               ((restaurant_id,) for restaurant_id in restaurant_ids))
             cursor.execute(
-                    '''UPDATE grid SET fetch_status = 2,commit_date = datetime('now','localtime') WHERE geohash = ?''',
-                    (geohash,))
+                    '''UPDATE grid SET fetch_status = ?,commit_date = datetime('now','localtime') WHERE geohash = ?''',
+                    (status_code, geohash))
 
             conn.commit()
-            row = cursor.execute('select count(*) from grid where fetch_status != 0 and fetch_status != 1').fetchone()
+            row = cursor.execute('SELECT COUNT(*),TOTAL(fetch_status != 0 AND fetch_status != 1) FROM grid').fetchone()
             if row is not None:
-                self.num_finished = row[0]
+                self.num_cells = row[0]
+                self.num_finished = int(row[1])
 
         with db_utils.connect_database(self.db_names['data']) as conn:
             row = conn.execute('SELECT COUNT(*) FROM restaurants').fetchone()
             if row is not None:
                 self.num_restaurants = row[0]
+        self.log_sink.flush_if_due()
         self._refresh_output()
 
     def _refresh_output(self):
@@ -82,45 +157,64 @@ class RestaurantFetcher(object):
                           os.getpid()))
         sys.stdout.flush()
 
-    def _store_restaurants(self, geohash, minor_cat, restaurants):
-        restaurants_json = json.loads(restaurants)
-        for r_json in restaurants_json:
-            self._restaurant_cache.append((
-                r_json['id'],
-                r_json['name'],
-                r_json['name_for_url'],
-                r_json['rating'],
-                r_json['rating_count'],
-                r_json['month_sales'],
-                r_json['phone'],
-                r_json['latitude'],
-                r_json['longitude'],
-                r_json['is_free_delivery'],
-                r_json['delivery_fee'],
-                r_json['minimum_order_amount'],
-                r_json['minimum_free_delivery_amount'],
-                r_json['promotion_info'],
-                r_json['address']
-            ))
-            self._category_cache.append((
-                minor_cat,
-                r_json['id'],
-                minor_cat,
-                r_json['id'],
-            ))
-
-    def _fetch_cell_category(self, geohash, minor_cat):
-        while True:
+    def _store_restaurants(self, geohash, minor_cat, content):
+        """
+        :return: 商家数量
+        """
+        restaurants = self.parser.parse_restaurants(content)
+        self._restaurant_cache.extend(restaurants)
+        self._category_cache.extend((minor_cat, restaurant[0]) for restaurant in restaurants)
+        if self.record_cells:
+            self._cell_cache.extend((restaurant[0], geohash) for restaurant in restaurants)
+        return len(restaurants)
+
+    def _fetch_page(self, geohash, minor_cat, offset):
+        """
+        :return: 本页商家数量, 超过重试次数时为None
+        """
+        for attempt in range(0, self.retry_policy.max_attempts):
+            self.circuit_breaker.wait()
             try:
-                r = requests.get(url_utils.create_fetch_restaurant_url(geohash, minor_cat), timeout=_REQUEST_TIMEOUT)
-                if r.status_code == requests.codes.ok:
-                    self._store_restaurants(geohash, minor_cat, r.text)
-                    break
+                url = url_utils.create_fetch_restaurant_url(geohash, minor_cat, offset, self.page_size)
+                r = self.transport.get(url, timeout=_REQUEST_TIMEOUT)
+                if r.status_code == HTTPStatus.OK:
+                    self.circuit_breaker.record_success()
+                    return self._store_restaurants(geohash, minor_cat, r.content)
                 else:
+                    self.circuit_breaker.record_failure()
                     self._log_http_error(geohash, r.status_code, r.text)
             except Exception as e:
+                self.circuit_breaker.record_failure()
                 self._log_exception(geohash, str(e))
-                continue
+            # 最后一次失败后不再等待
+            if attempt < self.retry_policy.max_attempts - 1:
+                time.sleep(self.retry_policy.delay(attempt))
+        return None
+
+    def _has_next_page(self, geohash, minor_cat, page_count, count):
+        if page_count < self.page_size:
+            return False
+        # 需要拆分的网格不再翻页, 由子网格抓取
+        if self._can_split(geohash) and count >= self.split_threshold:
+            return False
+        if count >= self.max_offset:
+            self._log_exception(geohash, '分类%d翻页达到上限(offset=%d), 之后的商家没有抓取' % (minor_cat, count))
+            return False
+        return True
+
+    def _fetch_cell_category(self, geohash, minor_cat):
+        """
+        逐页抓取, 每页的数据直接放入写入缓存
+        :return: 商家数量, 超过重试次数时为None
+        """
+        count = 0
+        while True:
+            page_count = self._fetch_page(geohash, minor_cat, count)
+            if page_count is None:
+                return None
+            count += page_count
+            if not self._has_next_page(geohash, minor_cat, page_count, count):
+                return count
 
     def _num_cells(self):
         with db_utils.connect_database(self.db_names['status']) as conn:
@@ -128,53 +222,90 @@ class RestaurantFetcher(object):
             return row[0] if row is not None else 0
 
     def _write_cache_to_database(self):
-        with db_utils.connect_database(self.db_names['data']) as conn:
-            cursor = conn.cursor()
-            cursor.executemany('''
-                INSERT OR IGNORE INTO restaurants VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
-                ''', self._restaurant_cache)
-            cursor.executemany('''
-                INSERT INTO restaurant_categories(category_id,restaurant_id)
-                SELECT ?,?
-                WHERE NOT EXISTS(SELECT 1 FROM restaurant_categories WHERE category_id = ? AND restaurant_id = ?)
-                ''', self._category_cache)
-            conn.commit()
+        if self.incremental:
+            batches = [('restaurants_upsert', self._restaurant_cache),
+                       ('crawl_seen', [restaurant[:1] for restaurant in self._restaurant_cache])]
+        else:
+            batches = [('restaurants', self._restaurant_cache)]
+        batches.append(('restaurant_categories', self._category_cache))
+        batches.append(('restaurant_cells', self._cell_cache))
+        self.data_writer.write(batches)
         self._restaurant_cache = []
         self._category_cache = []
+        self._cell_cache = []
 
-    def _fetch_cell(self, geohash):
-        for major, minors in RESTAURANT_CATEGORIES.items():
-            for minor in minors:
-                self._fetch_cell_category(geohash, minor)
+    @staticmethod
+    def _cell_categories(categories):
+        """
+        :param categories: grid.categories, 逗号分隔的分类id, None为全部分类
+        """
+        if categories is None:
+            return [minor for major, minors in RESTAURANT_CATEGORIES.items() for minor in minors]
+        return [int(minor) for minor in categories.split(',')]
+
+    def _can_split(self, geohash):
+        return self.max_precision is not None and len(geohash) < self.max_precision
+
+    def _split_geohash(self, geohash, categories):
+        children = [(child, ','.join(str(minor) for minor in categories))
+                    for child in geo_grid.geohash_children(geohash)]
+        with db_utils.connect_database(self.db_names['status']) as conn:
+            conn.executemany('INSERT OR IGNORE INTO grid(geohash,categories) VALUES(?,?)', children)
+            conn.commit()
+
+    def _complete_cell(self, geohash, counts):
+        """
+        :param counts: {分类id: 商家数量或None}
+        """
+        restaurant_ids = set(restaurant[0] for restaurant in self._restaurant_cache) if self.enqueue_menus else ()
         self._write_cache_to_database()
-        self._finish_geohash(geohash)
+        if self._can_split(geohash):
+            dense = [minor for minor, count in counts.items() if count is not None and count >= self.split_threshold]
+            if len(dense) != 0:
+                self._split_geohash(geohash, dense)
+        succeeded = all(count is not None for count in counts.values())
+        self._finish_geohash(geohash, 2 if succeeded else FETCH_STATUS_FAILED, restaurant_ids)
+
+    def _fetch_cell(self, geohash, categories=None):
+        counts = {}
+        for minor in self._cell_categories(categories):
+            counts[minor] = self._fetch_cell_category(geohash, minor)
+        self._complete_cell(geohash, counts)
 
     def run(self):
         geohash = self._take_geohash()
         while geohash is not None:
-            self._fetch_cell(geohash[0])
+            self._fetch_cell(geohash[0], geohash[1])
             geohash = self._take_geohash()
+        self.log_sink.flush()
 
 
 class MenuFetcher(object):
-    def __init__(self, db_names):
+    def __init__(self, db_names, transport=None, lease_size=_DEFAULT_LEASE_SIZE, retry_policy=None,
+                 circuit_breaker=None, log_sink=None, data_writer=None, parser=None):
         self.db_names = db_names
+        self.transport = transport if transport is not None else PooledTransport()
+        self.lease_size = lease_size
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self.circuit_breaker = circuit_breaker if circuit_breaker is not None else CircuitBreaker()
+        self.log_sink = log_sink if log_sink is not None else LogSink(db_names['log'])
+        self.data_writer = data_writer if data_writer is not None else DirectWriter(db_names['data'])
+        self.parser = parser if parser is not None else ProjectingParser()
+        self._leased = collections.deque()
+        self._versions = {}
         self.num_restaurants = self._num_restaurants()
         self.num_finished = 0
         self.num_menus = 0
         self._menu_cache = []
+        self._changed_cache = []
+        self._version_cache = []
+        self._unchanged_cache = []
 
     def _log_http_error(self, restaurant_id, http_code, error_msg):
-        with db_utils.connect_database(self.db_names['log']) as conn:
-            conn.execute('INSERT INTO fetch_menu_log VALUES(?,?,?)',
-                         (restaurant_id, http_code, error_msg))
-            conn.commit()
+        self.log_sink.log_http_error('fetch_menu_log', restaurant_id, http_code, error_msg)
 
     def _log_exception(self, restaurant_id, exception):
-        with db_utils.connect_database(self.db_names['log']) as conn:
-            conn.execute('INSERT INTO fetch_menu_exception VALUES(?,?)',
-                         (restaurant_id, exception))
-            conn.commit()
+        self.log_sink.log_exception('fetch_menu_exception', restaurant_id, exception)
 
     def _refresh_output(self):
         sys.stdout.write("\r抓取菜单数据(%d/%d) %.2f%% 菜单数:%d pid:%d" %
@@ -189,24 +320,55 @@ class MenuFetcher(object):
             row = conn.execute('SELECT COUNT(*) FROM restaurants').fetchone()
             return row[0] if row is not None else 0
 
-    def _take_restaurant(self):
+    def _lease_restaurants(self):
         with db_utils.connect_database(self.db_names['status'], isolation_level='EXCLUSIVE') as conn:
             cursor = conn.cursor()
             cursor.execute('BEGIN EXCLUSIVE')
-            row = cursor.execute('SELECT id FROM restaurants WHERE fetch_status = 0 LIMIT 1').fetchone()
-            if row is not None:
-                cursor.execute('UPDATE restaurants SET fetch_status = 1 WHERE id = ?', row)
+            rows = cursor.execute('SELECT id FROM restaurants WHERE fetch_status = 0 LIMIT ?',
+                                  (self.lease_size,)).fetchall()
+            cursor.executemany('UPDATE restaurants SET fetch_status = 1 WHERE id = ?', rows)
             conn.commit()
-            return row
+            self._leased.extend(rows)
+        self._load_versions([row[0] for row in rows])
+
+    def _load_versions(self, restaurant_ids):
+        """
+        读取上一次抓取时菜单的指纹和缓存校验头
+        """
+        if len(restaurant_ids) == 0:
+            return
+        with db_utils.connect_database(self.db_names['data']) as conn:
+            rows = conn.execute('SELECT restaurant_id,fingerprint,etag,last_modified FROM menu_versions '
+                                'WHERE restaurant_id IN ({})'.format(','.join('?' * len(restaurant_ids))),
+                                restaurant_ids).fetchall()
+        for restaurant_id, fingerprint, etag, last_modified in rows:
+            self._versions[restaurant_id] = (fingerprint, etag, last_modified)
+
+    def _conditional_headers(self, restaurant_id):
+        version = self._versions.get(restaurant_id)
+        if version is None:
+            return None
+        headers = {}
+        if version[1] is not None:
+            headers['If-None-Match'] = version[1]
+        if version[2] is not None:
+            headers['If-Modified-Since'] = version[2]
+        return headers
+
+    def _take_restaurant(self):
+        if len(self._leased) == 0:
+            self._lease_restaurants()
+        return self._leased.popleft() if len(self._leased) != 0 else None
 
     def _write_cache_to_database(self):
-        with db_utils.connect_database(self.db_names['data']) as conn:
-            conn.executemany('''
-                INSERT INTO menus(restaurant_id,name,pinyin_name,rating,rating_count,price,month_sales,description,category_id)
-                VALUES(?,?,?,?,?,?,?,?,?)
-            ''', self._menu_cache)
-            conn.commit()
+        self.data_writer.write([('delete_menus', self._changed_cache),
+                                ('menus', self._menu_cache),
+                                ('menu_versions', self._version_cache),
+                                ('touch_menu_versions', self._unchanged_cache)])
         self._menu_cache = []
+        self._changed_cache = []
+        self._version_cache = []
+        self._unchanged_cache = []
 
     def _finish_restaurant(self, restaurant_id, status_code=2):
         with db_utils.connect_database(self.db_names['status']) as conn:
@@ -215,61 +377,78 @@ class MenuFetcher(object):
                     '''UPDATE restaurants SET fetch_status = ?,commit_date = datetime('now','localtime') WHERE id = ?''',
                     (status_code, restaurant_id))
             conn.commit()
+            # 流水线模式下商家数量还在增加
             row = cursor.execute(
-                    'select count(*) from restaurants where fetch_status != 0 and fetch_status != 1').fetchone()
+                    'SELECT COUNT(*),TOTAL(fetch_status != 0 AND fetch_status != 1) FROM restaurants').fetchone()
             if row is not None:
-                self.num_finished = row[0]
+                self.num_restaurants = row[0]
+                self.num_finished = int(row[1])
 
         with db_utils.connect_database(self.db_names['data']) as conn:
             row = conn.execute('SELECT COUNT(*) FROM menus').fetchone()
             if row is not None:
                 self.num_menus = row[0]
+        self.log_sink.flush_if_due()
         self._refresh_output()
 
     @staticmethod
-    def _sum_price(specfoods_json):
-        price = 0
-        for f_json in specfoods_json:
-            price += float(f_json['price'])
-
-        count = len(specfoods_json)
-        if count is not 0:
-            price /= count
-
-        return price
-
-    def _store_menus(self, restaurant_id, menus):
-        menus_json = json.loads(menus)
-        for menu_category_json in menus_json:  # 分类
-            for food_json in menu_category_json['foods']:
-                self._menu_cache.append((
-                    food_json['restaurant_id'],
-                    food_json['name'],
-                    food_json['pinyin_name'],
-                    food_json['rating'],
-                    food_json['rating_count'],
-                    self._sum_price(food_json['specfoods']),
-                    food_json['month_sales'],
-                    food_json['description'],
-                    food_json['category_id'],
-                ))
+    def _fingerprint(menus):
+        return hashlib.sha1(repr(sorted(menus, key=repr)).encode('utf-8')).hexdigest()
+
+    def _store_menus(self, restaurant_id, content, etag=None, last_modified=None):
+        """
+        菜单的指纹与上一次相同时只更新commit_date, 不重写menus表
+        """
+        menus = self.parser.parse_menus(content)
+        fingerprint = self._fingerprint(menus)
+        version = self._versions.pop(restaurant_id, None)
+        if version is not None and version[0] == fingerprint:
+            self._unchanged_cache.append((etag, last_modified, restaurant_id))
+            return
+
+        self._changed_cache.append((restaurant_id,))
+        self._menu_cache.extend(menus)
+        self._version_cache.append((restaurant_id, fingerprint, etag, last_modified))
+
+    def _handle_response(self, restaurant_id, r):
+        """
+        :return: 是否已完成该商家(成功, 未修改或404)
+        """
+        if r.status_code == HTTPStatus.OK:
+            self.circuit_breaker.record_success()
+            self._store_menus(restaurant_id, r.content, r.header('ETag'), r.header('Last-Modified'))
+            self._finish_restaurant(restaurant_id)
+            return True
+        elif r.status_code == HTTPStatus.NOT_MODIFIED:
+            self.circuit_breaker.record_success()
+            self._versions.pop(restaurant_id, None)
+            self._unchanged_cache.append((None, None, restaurant_id))
+            self._finish_restaurant(restaurant_id)
+            return True
+        elif r.status_code == HTTPStatus.NOT_FOUND:
+            self.circuit_breaker.record_success()
+            self._log_http_error(restaurant_id, r.status_code, r.text)
+            self._finish_restaurant(restaurant_id, r.status_code)
+            return True
+        else:
+            self.circuit_breaker.record_failure()
+            self._log_http_error(restaurant_id, r.status_code, r.text)
+            return False
 
     def _fetch_restaurant(self, restaurant_id):
-        while True:
+        for attempt in range(0, self.retry_policy.max_attempts):
+            self.circuit_breaker.wait()
             try:
-                r = requests.get(url_utils.create_fetch_menu_url(restaurant_id), timeout=_REQUEST_TIMEOUT)
-                if r.status_code == requests.codes.ok:
-                    self._store_menus(restaurant_id, r.text)
-                    self._finish_restaurant(restaurant_id)
-                    break
-                elif r.status_code == requests.codes.not_found:
-                    self._log_http_error(restaurant_id, r.status_code, r.text)
-                    self._finish_restaurant(restaurant_id, r.status_code)
-                    break
-                else:
-                    self._log_http_error(restaurant_id, r.status_code, r.text)
+                r = self.transport.get(url_utils.create_fetch_menu_url(restaurant_id), timeout=_REQUEST_TIMEOUT,
+                                       headers=self._conditional_headers(restaurant_id))
+                if self._handle_response(restaurant_id, r):
+                    return
             except Exception as e:
+                self.circuit_breaker.record_failure()
                 self._log_exception(restaurant_id, str(e))
+            if attempt < self.retry_policy.max_attempts - 1:
+                time.sleep(self.retry_policy.delay(attempt))
+        self._finish_restaurant(restaurant_id, FETCH_STATUS_FAILED)
 
     def run(self):
         restaurant_id = self._take_restaurant()
@@ -277,39 +456,143 @@ class MenuFetcher(object):
             self._fetch_restaurant(restaurant_id[0])
             self._write_cache_to_database()
             restaurant_id = self._take_restaurant()
+        self.log_sink.flush()
+
 
+class PipelineFetcher(object):
+    """
+    同时抓取网格和菜单: 网格完成后其中的商家立即进入菜单队列.
+    一半的抓取器优先抓取菜单, 另一半优先抓取网格, 一种任务没有时都去做另一种, 两个阶段共用所有线程
+    """
 
-def fetch_restaurant_threading(db_names):
-    RestaurantFetcher(db_names).run()
+    _worker_ids = itertools.count()
 
+    def __init__(self, db_names, transport=None, poll_interval=_DEFAULT_POLL_INTERVAL, **options):
+        self.db_names = db_names
+        self.poll_interval = poll_interval
+        self.prefer_menus = next(PipelineFetcher._worker_ids) % 2 == 1
+        # 两个抓取器共用日志缓冲和写入器
+        if 'log_sink' not in options:
+            options['log_sink'] = LogSink(db_names['log'])
+        if 'data_writer' not in options:
+            options['data_writer'] = DirectWriter(db_names['data'])
+        self.log_sink = options['log_sink']
+
+        restaurant_options = dict(options, enqueue_menus=True)
+        # 优先抓取菜单的抓取器每次只领取一个网格, 不占住其他抓取器可以做的网格
+        if self.prefer_menus:
+            restaurant_options['lease_size'] = 1
+        menu_options = dict((key, value) for key, value in options.items() if key in _MENU_OPTIONS)
+        self.restaurant_fetcher = self._create_restaurant_fetcher(transport, restaurant_options)
+        self.menu_fetcher = self._create_menu_fetcher(transport, menu_options)
+
+    def _create_restaurant_fetcher(self, transport, options):
+        return RestaurantFetcher(self.db_names, transport, **options)
+
+    def _create_menu_fetcher(self, transport, options):
+        return MenuFetcher(self.db_names, transport, **options)
+
+    def _grid_finished(self):
+        with db_utils.connect_database(self.db_names['status']) as conn:
+            row = conn.execute('SELECT COUNT(*) FROM grid WHERE fetch_status = 0 OR fetch_status = 1').fetchone()
+            return row[0] == 0
+
+    def _fetch_menu(self):
+        restaurant_id = self.menu_fetcher._take_restaurant()
+        if restaurant_id is None:
+            return False
+        self.menu_fetcher._fetch_restaurant(restaurant_id[0])
+        self.menu_fetcher._write_cache_to_database()
+        return True
+
+    def _fetch_cell(self):
+        geohash = self.restaurant_fetcher._take_geohash()
+        if geohash is None:
+            return False
+        self.restaurant_fetcher._fetch_cell(geohash[0], geohash[1])
+        return True
+
+    def _step(self):
+        if self.prefer_menus:
+            return self._fetch_menu() or self._fetch_cell()
+        return self._fetch_cell() or self._fetch_menu()
 
-def fetch_menu_threading(db_names):
-    MenuFetcher(db_names).run()
+    def run(self):
+        while True:
+            if self._step():
+                continue
+            # 网格完成和商家入队在同一个事务中, 网格全部完成后菜单队列不会再增加
+            if self._grid_finished():
+                if not self._fetch_menu():
+                    break
+            else:
+                time.sleep(self.poll_interval)
+        self.log_sink.flush()
 
 
-def fetch_restaurant_processor(db_names, num_threading):
+def fetch_restaurant_threading(db_names, transport=None, **options):
+    RestaurantFetcher(db_names, transport, **options).run()
+
+
+def fetch_menu_threading(db_names, transport=None, **options):
+    MenuFetcher(db_names, transport, **options).run()
+
+
+def fetch_pipeline_threading(db_names, transport=None, **options):
+    PipelineFetcher(db_names, transport, **options).run()
+
+
+def fetch_restaurant_processor(db_names, num_threading, **options):
+    print('进程%d已启动' % os.getpid())
+    ThreadingLauncher(db_names, fetch_restaurant_threading, num_threading, **options).run()
+    print('\n进程%d已结束' % os.getpid())
+
+
+def fetch_menu_processor(db_names, num_threading, **options):
     print('进程%d已启动' % os.getpid())
-    ThreadingLauncher(db_names, fetch_restaurant_threading, num_threading).run()
+    ThreadingLauncher(db_names, fetch_menu_threading, num_threading, **options).run()
     print('\n进程%d已结束' % os.getpid())
 
 
-def fetch_menu_processor(db_names, num_threading):
+def fetch_pipeline_processor(db_names, num_threading, **options):
     print('进程%d已启动' % os.getpid())
-    ThreadingLauncher(db_names, fetch_menu_threading, num_threading).run()
+    ThreadingLauncher(db_names, fetch_pipeline_threading, num_threading, **options).run()
     print('\n进程%d已结束' % os.getpid())
 
 
+def stop_data_writer(data_writer, db_names):
+    """
+    写入进程异常退出时, 最后一次提交之后完成的任务的数据已经丢失, 重置这些任务的状态后再抛出异常
+    """
+    try:
+        data_writer.stop()
+    except DataWriterError as e:
+        db_utils.reset_unconfirmed_status(db_names, e.committed_until)
+        raise
+
+
 class ThreadingLauncher(object):
-    def __init__(self, db_names, target_func, num_threading=8):
+    """
+    options会原样传给每个线程创建的抓取器
+    """
+
+    def __init__(self, db_names, target_func, num_threading=8, transport=None, **options):
         self.db_names = db_names
         self.target_func = target_func
         self.num_threading = num_threading
+        self.options = options
+        # 同一进程内的线程共享熔断器和日志缓冲
+        self.options.setdefault('circuit_breaker', CircuitBreaker())
+        self.options.setdefault('log_sink', LogSink(db_names['log']))
+        # 同一进程内的线程共享连接池, 每个host的连接数与线程数一致
+        self.transport = transport if transport is not None else PooledTransport(max_per_host=num_threading)
 
     def run(self):
         threads = []
 
         for n in range(0, self.num_threading):
-            threads.append(threading.Thread(target=self.target_func, args=(self.db_names,)))
+            threads.append(threading.Thread(target=self.target_func, args=(self.db_names, self.transport),
+                                            kwargs=self.options))
 
         for thread in threads:
             thread.start()
@@ -317,22 +600,37 @@ class ThreadingLauncher(object):
         for thread in threads:
             thread.join()
 
+        self.transport.close()
+        print('\n进程%d %s' % (os.getpid(), self.transport.stats.summary()))
+
 
 class ProcessingLauncher(object):
-    def __init__(self, db_names, target_func, num_processing=2, num_threading=8):
+    def __init__(self, db_names, target_func, num_processing=2, num_threading=8, **options):
         self.db_names = db_names
         self.target_func = target_func
         self.num_processing = num_processing
         self.num_threading = num_threading
+        self.options = options
+        # 熔断状态保存在共享内存中, 所有进程一起暂停
+        self.options.setdefault('circuit_breaker', CircuitBreaker())
 
     def run(self):
+        # 所有进程的数据都交给同一个写入进程
+        data_writer = DataWriterProcess(self.db_names['data'])
+        data_writer.start()
+        options = dict(self.options)
+        options.setdefault('data_writer', data_writer.client())
+
         processes = []
 
         for n in range(0, self.num_processing):
             processes.append(multiprocessing.Process(target=self.target_func,
-                                                     args=(self.db_names, self.num_threading)))
+                                                     args=(self.db_names, self.num_threading),
+                                                     kwargs=options))
         for processor in processes:
             processor.start()
 
         for processor in processes:
             processor.join()
+
+        stop_data_writer(data_writer, self.db_names)
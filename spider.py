@@ -12,11 +12,22 @@ _DEFAULT_DEPTH = 65
 _CENTRAL_SEQUENCE = ['wtw3esj', 'wtw3ef9', 'wtw3syu', 'wtw2fy9']
 _CENTRAL_SEQUENCE_DEPTH = 25
 
+# 自适应网格最多拆分到的geohash精度
+_ADAPTIVE_MAX_PRECISION = 8
 
+
+# 抓取范围多边形的顶点[纬度, 经度], 使用-l时只抓取与其相交的网格
 _LIMIT_LONGLAT = [[31.2243287344,121.450360246], [31.2152904,121.4564706], [31.2384794,121.5033301], [31.1053198, 121.4114296]]
 
 
 
+def _positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError('%r is not a positive integer' % value)
+    return number
+
+
 def _parse_args():
     """
     :return: argparse.parse_args
@@ -24,34 +35,141 @@ def _parse_args():
     parse = argparse.ArgumentParser(description='ele.me spider v2.0')
     parse.add_argument('-d', '--db_name', help='Continuous task for database', dest='db_name')
     parse.add_argument('-a', '--analysis', help="Analysis only", dest='analysis')
+    parse.add_argument('--no-cache', help='Prepare the analysis data from the database again',
+                       dest='no_cache', action='store_true')
+    parse.add_argument('--report-format', help='Output format of the analysis reports', dest='report_format',
+                       choices=sorted(report_sink.SINKS), default='excel')
+    parse.add_argument('--report-processes', help='Processes generating the analysis reports in parallel',
+                       dest='report_processes', type=int, default=1)
     parse.add_argument('-l', '--limition', help='Limit range',action='store_true')
+    parse.add_argument('-r', '--radius', help='Only crawl cells within this many km of the central geohash',
+                       dest='radius', type=float)
     parse.add_argument('-c', '--central', help='Central geohash', dest='central')
     parse.add_argument('-p', '--depth', help='Depth of searching', dest='depth', type=int)
+    parse.add_argument('-e', '--engine', help='Fetch engine', dest='engine', choices=['thread', 'async'],
+                       default='thread')
+    parse.add_argument('-n', '--concurrency', help='Max requests in flight (async engine)', dest='concurrency',
+                       type=int, default=200)
+    parse.add_argument('-b', '--lease-size', help='Work items claimed per status db transaction',
+                       dest='lease_size', type=int, default=8)
+    parse.add_argument('--adaptive', help='Start from coarser geohash cells of this precision and split dense ones',
+                       dest='adaptive', type=int)
+    parse.add_argument('--page-size', help='Restaurants requested per page', dest='page_size', type=_positive_int,
+                       default=200)
+    parse.add_argument('--parser', help='Response parser', dest='parser', choices=sorted(parsers.PARSERS),
+                       default='projecting')
+    parse.add_argument('-k', '--keep-menus', help='Keep menus of the previous run and only rewrite changed ones',
+                       dest='keep_menus', action='store_true')
+    parse.add_argument('-i', '--incremental', help='Re-crawl on top of the previous databases and log changes',
+                       dest='incremental', action='store_true')
+    parse.add_argument('--refresh-order', help='Order of revisiting grid cells', dest='refresh_order',
+                       choices=['grid', 'oldest', 'random'], default='grid')
+    parse.add_argument('--refresh-age', help='Incremental: only re-crawl cells not crawled for this many hours',
+                       dest='refresh_age', type=float)
+    parse.add_argument('--refresh-limit', help='Incremental: re-crawl at most this many cells, oldest first',
+                       dest='refresh_limit', type=_positive_int)
+    parse.add_argument('-s', '--shared', help='Crawl all centrals of the sequence once on shared databases',
+                       dest='shared', action='store_true')
+    parse.add_argument('--pipeline', help='Fetch menus while the grid is still being crawled', dest='pipeline',
+                       action='store_true')
+    parse.add_argument('--max-attempts', help='Attempts per request before marking the item failed',
+                       dest='max_attempts', type=int, default=8)
     return parse.parse_args()
 
 
-def fetch_restaurants(db_names):
-    restaurant_fetcher = worker.ProcessingLauncher(db_names, worker.fetch_restaurant_processor)
+def _add_restaurant_options(options, adaptive=False, page_size=None, incremental=False, refresh_order='grid'):
+    """
+    只属于RestaurantFetcher的参数
+    """
+    if page_size is not None:
+        options['page_size'] = page_size
+    if adaptive is True:
+        options['max_precision'] = _ADAPTIVE_MAX_PRECISION
+    options['incremental'] = incremental
+    options['refresh_order'] = refresh_order
+
+
+def fetch_restaurants(db_names, engine='thread', concurrency=200, adaptive=False, page_size=None, incremental=False,
+                      refresh_order='grid', **options):
+    _add_restaurant_options(options, adaptive, page_size, incremental, refresh_order)
+    if engine == 'async':
+        restaurant_fetcher = aio_worker.create_restaurant_launcher(db_names, concurrency, **options)
+    else:
+        restaurant_fetcher = worker.ProcessingLauncher(db_names, worker.fetch_restaurant_processor, **options)
     restaurant_fetcher.run()
+    if incremental:
+        db_utils.finalize_incremental(db_names)
+    else:
+        db_utils.prune_kept_menus(db_names)
     # return db_names
 
-def fetch_menus(db_names):
-    db_utils.prepare_restaurant_status_table(db_names)
-    menu_fetcher = worker.ProcessingLauncher(db_names, worker.fetch_menu_processor)
+def fetch_menus(db_names, engine='thread', concurrency=200, incremental=False, **options):
+    db_utils.prepare_restaurant_status_table(db_names, incremental)
+    if engine == 'async':
+        menu_fetcher = aio_worker.create_menu_launcher(db_names, concurrency, **options)
+    else:
+        menu_fetcher = worker.ProcessingLauncher(db_names, worker.fetch_menu_processor, **options)
     menu_fetcher.run()
 
 
+def fetch_pipeline(db_names, engine='thread', concurrency=200, adaptive=False, page_size=None, incremental=False,
+                   refresh_order='grid', **options):
+    """
+    商家和菜单同时抓取, 网格完成后其中的商家立即开始抓取菜单
+    """
+    _add_restaurant_options(options, adaptive, page_size, incremental, refresh_order)
+    if engine == 'async':
+        pipeline_fetcher = aio_worker.create_pipeline_launcher(db_names, concurrency, **options)
+    else:
+        pipeline_fetcher = worker.ProcessingLauncher(db_names, worker.fetch_pipeline_processor, **options)
+    pipeline_fetcher.run()
+    if incremental:
+        db_utils.finalize_incremental(db_names)
+    else:
+        db_utils.prune_kept_menus(db_names)
+
+
+
+def start_new_mission_sequence(engine='thread', concurrency=200, precision=None, page_size=None, keep_menus=False,
+                               incremental=False, refresh_order='grid', polygon=None, radius=None, pipeline=False,
+                               refresh_age=None, refresh_limit=None, **options):
+    db_name_sequence = db_utils.create_database_sequence(_CENTRAL_SEQUENCE, _CENTRAL_SEQUENCE_DEPTH, precision,
+                                                         keep_menus, incremental, polygon, radius, refresh_age,
+                                                         refresh_limit)
+    if pipeline:
+        for db_names in db_name_sequence:
+            fetch_pipeline(db_names, engine, concurrency, precision is not None, page_size, incremental,
+                           refresh_order, **options)
+        return
 
-def start_new_mission_sequence():
-    db_name_sequence = db_utils.create_database_sequence(_CENTRAL_SEQUENCE, _CENTRAL_SEQUENCE_DEPTH)
     for db_names in db_name_sequence:
-        fetch_restaurants(db_names)
+        fetch_restaurants(db_names, engine, concurrency, precision is not None, page_size, incremental, refresh_order,
+                          **options)
     for db_names in db_name_sequence:
-        fetch_menus(db_names)
+        fetch_menus(db_names, engine, concurrency, incremental, **options)
 
 
 
-def start_analysis_mission(db_name, limition=False):
+def start_shared_mission_sequence(engine='thread', concurrency=200, precision=None, page_size=None, keep_menus=False,
+                                  incremental=False, refresh_order='grid', polygon=None, radius=None, pipeline=False,
+                                  refresh_age=None, refresh_limit=None, **options):
+    """
+    所有中心的网格合并后只抓取一次, 重叠区域的商家和菜单不会重复抓取, 最后分配到各个中心的数据库
+    """
+    shared_names = db_utils.create_shared_database(_CENTRAL_SEQUENCE, _CENTRAL_SEQUENCE_DEPTH, precision,
+                                                   keep_menus, incremental, polygon, radius, refresh_age, refresh_limit)
+    if pipeline:
+        fetch_pipeline(shared_names, engine, concurrency, precision is not None, page_size, incremental, refresh_order,
+                       record_cells=True, **options)
+    else:
+        fetch_restaurants(shared_names, engine, concurrency, precision is not None, page_size, incremental,
+                          refresh_order, record_cells=True, **options)
+        fetch_menus(shared_names, engine, concurrency, incremental, **options)
+    return db_utils.distribute_shared_database(shared_names, _CENTRAL_SEQUENCE)
+
+
+def start_analysis_mission(db_name, limition=False, radius=None, use_cache=True, report_format='excel',
+                           num_processing=1):
     print('开始分析数据:', db_name)
 
     lon = None
@@ -60,21 +178,39 @@ def start_analysis_mission(db_name, limition=False):
     if limition is True:
         lat,lon = geohash.decode(db_name)
 
-    analyzer = topline.Analyzer(db_name, lon, lat, 3)
-    analyzer.generate()
+    analyzer = topline.Analyzer(db_name, lon, lat, radius if radius is not None else 3, use_cache)
+    analyzer.generate(report_format, num_processing)
 
 
 if __name__ == '__main__':
     args = _parse_args()
+    fetcher_options = {'lease_size': args.lease_size,
+                       'retry_policy': retry.RetryPolicy(max_attempts=args.max_attempts),
+                       'parser': parsers.PARSERS[args.parser]()}
+    polygon = _LIMIT_LONGLAT if args.limition else None
 
     if args.analysis is not None:
-        start_analysis_mission(args.analysis, False if not args.limition else True)
-    elif args.central is not None and args.depth is not None:
-        db_name_sequences = db_utils.create_database_sequence([args.central], args.depth)
-        fetch_restaurants(db_name_sequences[0])
-        fetch_menus(db_name_sequences[0])
+        start_analysis_mission(args.analysis, False if not args.limition else True, args.radius, not args.no_cache,
+                               args.report_format, args.report_processes)
+    elif args.central is not None and (args.depth is not None or args.limition or args.radius is not None):
+        db_name_sequences = db_utils.create_database_sequence([args.central], args.depth, args.adaptive,
+                                                              args.keep_menus, args.incremental, polygon,
+                                                              args.radius, args.refresh_age, args.refresh_limit)
+        if args.pipeline:
+            fetch_pipeline(db_name_sequences[0], args.engine, args.concurrency, args.adaptive is not None,
+                           args.page_size, args.incremental, args.refresh_order, **fetcher_options)
+        else:
+            fetch_restaurants(db_name_sequences[0], args.engine, args.concurrency, args.adaptive is not None,
+                              args.page_size, args.incremental, args.refresh_order, **fetcher_options)
+            fetch_menus(db_name_sequences[0], args.engine, args.concurrency, args.incremental, **fetcher_options)
+    elif args.shared:
+        start_shared_mission_sequence(args.engine, args.concurrency, args.adaptive, args.page_size, args.keep_menus,
+                                      args.incremental, args.refresh_order, polygon, args.radius, args.pipeline,
+                                      args.refresh_age, args.refresh_limit, **fetcher_options)
     else:
-        start_new_mission_sequence()
+        start_new_mission_sequence(args.engine, args.concurrency, args.adaptive, args.page_size, args.keep_menus,
+                                   args.incremental, args.refresh_order, polygon, args.radius, args.pipeline,
+                                   args.refresh_age, args.refresh_limit, **fetcher_options)
 
     # elif args.db_name is not None:
         # pass